@@ -0,0 +1,157 @@
+"""Load generator for the BurijjiServer msgpack socket protocol.
+
+Hosts a stub machine that produces raw, info and temperature traffic at
+configurable rates, connects N client processes over the AF_UNIX socket and
+reports end-to-end latency, throughput and server CPU per message as JSON.
+
+    python bench/protocol_bench.py --clients 20 --raw-rate 500 --duration 10
+"""
+import os, sys, json, time, socket, select, argparse, resource, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'burijji'))
+
+import msgpack
+from server  import BurijjiServer
+from metrics import Histogram
+
+class StubMachine:
+    """Stands in for repWrapper/mbWrapper, producing traffic instead of talking to a printer."""
+    _tick = 0.01
+
+    def __init__(self, server, port, baud, protocol):
+        self._server       = server
+        self.port          = port
+        self.baud          = baud
+        self.protocol      = protocol['protocol']
+        self.machine_id    = port.split('/')[-1]
+        self.running       = True
+        self._rates        = protocol['rates']
+        self._due          = dict((kind, 0.0) for kind in self._rates)
+        self._subscribers  = {'temperature': [], 'info': [], 'raw': []}
+        self._lines        = 0
+
+    def start(self):
+        self._server.call_soon(self._run)
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        return({'lines': self._lines})
+
+    def _run(self):
+        if not (self.running and self._server.running): return
+        for kind, rate in self._rates.iteritems():
+            self._due[kind] += rate * self._tick
+            while self._due[kind] >= 1:
+                self._due[kind] -= 1
+                self._emit(kind)
+        self._server.call_later(self._tick, self._run)
+
+    def _emit(self, kind):
+        if kind == 'raw':
+            self._lines += 1
+            data = 'ok N' + str(self._lines)
+        elif kind == 'temperature':
+            data = {'t': 210.0, 'b': 60.0}
+        else:
+            data = {'current_line': self._lines, 'printing': True, 'paused': False, 'current_segment': 'printing', 'machine_info': {'type': 'Bench'}}
+        self._server.broadcast(self._subscribers[kind], {'action': kind, 'machine': self.machine_id, 'data': data, 'sent_at': time.time()}, kind)
+
+    def machine_info(self, fileno, data):
+        self._server.add_to_queue(fileno, {'action': 'machine_info', 'machine': self.machine_id, 'data': {'type': 'Bench'}, 'sent_at': data})
+
+    def subscribe(self, fileno, data):
+        kinds = self._subscribers.keys() if data['type'] == 'all' else [data['type']]
+        for kind in kinds: self._subscribers[kind].append(fileno)
+
+    def unsubscribe(self, fileno, data):
+        for subscribers in self._subscribers.values():
+            while fileno in subscribers: subscribers.remove(fileno)
+
+def run_client(path, duration, request_rate, results):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    client.sendall(msgpack.packb({'action': 'subscribe', 'data': {'type': 'all'}}))
+    unpacker     = msgpack.Unpacker()
+    latency      = Histogram()
+    round_trip   = Histogram()
+    counts       = {}
+    received     = 0
+    end          = time.time() + duration
+    next_request = time.time()
+
+    while time.time() < end:
+        if request_rate and time.time() >= next_request:
+            client.sendall(msgpack.packb({'action': 'machine_info', 'data': time.time()}))
+            next_request += 1.0 / request_rate
+        readable = select.select([client], [], [], 0.01)[0]
+        if not readable: continue
+        data = client.recv(65536)
+        if not data: break
+        received += len(data)
+        unpacker.feed(data)
+        for message in unpacker:
+            action         = message.get('action')
+            counts[action] = counts.get(action, 0) + 1
+            if action == 'machine_info': round_trip.add(time.time() - message['sent_at'])
+            elif 'sent_at' in message:   latency.add(time.time() - message['sent_at'])
+
+    client.close()
+    results.put({'messages': counts, 'bytes': received, 'latency': latency.report(), 'round_trip': round_trip.report()})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients',      type=int,   default=10)
+    parser.add_argument('--duration',     type=float, default=10.0)
+    parser.add_argument('--raw-rate',     type=float, default=200.0, help='raw lines per second')
+    parser.add_argument('--info-rate',    type=float, default=1.0,   help='info messages per second')
+    parser.add_argument('--temp-rate',    type=float, default=1.0,   help='temperature messages per second')
+    parser.add_argument('--request-rate', type=float, default=5.0,   help='machine_info requests per second per client')
+    parser.add_argument('--socket',       default='/tmp/burijji-bench.sock')
+    parser.add_argument('--output',       help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    # Keep the server's console chatter out of the JSON.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    if os.path.exists(args.socket): os.remove(args.socket)
+    BurijjiServer._machine_types['bench'] = StubMachine
+    server = BurijjiServer(None, args.socket, None, None, index_workers=0)
+    server.add_machine('/dev/bench0', 0, {'protocol': 'bench', 'rates': {'raw': args.raw_rate, 'info': args.info_rate, 'temperature': args.temp_rate}})
+    server.start()
+    while not os.path.exists(args.socket): time.sleep(0.01)
+
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_client, args=(args.socket, args.duration, args.request_rate, results)) for i in range(args.clients)]
+    usage   = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    for client in clients: client.start()
+    reports = [results.get() for client in clients]
+    elapsed = time.time() - started
+    cpu     = resource.getrusage(resource.RUSAGE_SELF)
+    for client in clients: client.join()
+    server.stop()
+
+    latency    = Histogram()
+    round_trip = Histogram()
+    messages   = 0
+    for report in reports:
+        messages += sum(report['messages'].values())
+        for merged, name in [(latency, 'latency'), (round_trip, 'round_trip')]:
+            merged.counts = [a + b for a, b in zip(merged.counts, report[name]['buckets'])]
+            merged.count += report[name]['count']
+            merged.total += report[name]['mean'] * report[name]['count']
+            merged.max    = max(merged.max, report[name]['max'])
+
+    server_cpu = (cpu.ru_utime - usage.ru_utime) + (cpu.ru_stime - usage.ru_stime)
+    output = {'config': vars(args), 'elapsed': elapsed, 'messages': messages, 'messages_per_second': messages / elapsed,
+              'bytes': sum(r['bytes'] for r in reports), 'server_cpu_seconds': server_cpu,
+              'server_cpu_per_message': server_cpu / messages if messages else None,
+              'latency': latency.report(), 'round_trip': round_trip.report(), 'clients': reports}
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(output, f, indent=2)
+    else:
+        stdout.write(json.dumps(output, indent=2) + '\n')
+
+if __name__ == '__main__':
+    main()
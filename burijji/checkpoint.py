@@ -0,0 +1,84 @@
+import os
+import json
+import tempfile
+import threading
+
+class Checkpoint:
+    """Where a machine's print has got to, kept in a small JSON file.
+
+    save() only writes when the state changed and `interval` seconds have
+    passed, on a thread of its own so the fsync never stalls the server
+    loop. Files are replaced with a rename, a crash leaves the previous
+    checkpoint or the new one but never half of either.
+    """
+    interval = 5
+
+    def __init__(self, path):
+        self.path     = path
+        self._last    = None
+        self._due     = 0
+        self._writing = threading.Lock()
+
+    def save(self, state, now, force=False):
+        if state == self._last or (now < self._due and not force): return
+        if not self._writing.acquire(False): return
+        self._last = state
+        self._due  = now + self.interval
+        threading.Thread(target=self._write, args=[state]).start()
+
+    def _write(self, state):
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory): os.makedirs(directory)
+            fd, temp = tempfile.mkstemp('.tmp', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.path)
+        except (IOError, OSError) as e:
+            print "Checkpoint: could not write '" + self.path + "'", e
+        finally:
+            self._writing.release()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return(json.load(f))
+        except (IOError, OSError, ValueError):
+            return(None)
+
+    def clear(self):
+        self._last = None
+        with self._writing:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+def resume_commands(state, targets=None, routine=None):
+    """G-code that puts a machine that lost its place back into `state`, the
+    GCodeSource.state_at() just before the line a print resumes from.
+
+    Heaters are brought back to the file's setpoints (or `targets` for the
+    ones it didn't set recently), `routine` runs next (typically homing X
+    and Y), then Z is declared rather than homed, since the print is in
+    the way. Without a routine X and Y are homed with G28 once the head is
+    lifted 1 mm, the position they had went with the power. The head is
+    brought over the next move 1 mm above the print before the extruder
+    and modes are restored."""
+    setpoints = dict(targets or {})
+    setpoints.update(state['temperatures'])
+    setpoints = dict((heater, temperature) for heater, temperature in setpoints.iteritems() if temperature)
+    commands  = []
+    for heater, temperature in sorted(setpoints.iteritems()):
+        if heater.startswith('b'): commands += ['M140 S' + str(temperature), 'M190 S' + str(temperature)]
+    for heater, temperature in sorted(setpoints.iteritems()):
+        if heater.startswith('t'): commands += ['M109 ' + ('T' + heater[1:] + ' ' if heater[1:] else '') + 'S' + str(temperature)]
+    commands += list(routine or [])
+    commands += ['G90', 'G92 Z%.3f' % state['z'], 'G1 Z%.3f' % (state['z'] + 1)]
+    if not routine: commands.append('G28 X Y')
+    commands += ['G1 X%.3f Y%.3f' % (state['x'], state['y']), 'G1 Z%.3f' % state['z']]
+    commands += ['M83' if state['relative_e'] else 'M82', 'G92 E%.5f' % state['e'], 'G1 F%.1f' % state['feedrate']]
+    if state['relative']: commands.append('G91')
+    return(commands)
@@ -0,0 +1,295 @@
+"""Clients for the BurijjiServer msgpack socket protocol.
+
+Every request carries an 'id' the server echoes on its replies (or on an
+'ack' when the action has none), so requests can be pipelined and replies
+told apart from the subscription traffic they arrive among.
+
+    client = Client('/tmp/burijji.sock')
+    client.request('machine_info')
+    client.subscribe('temperature')
+    for message in client.messages(timeout=5): print message
+
+Delta subscriptions carry a version that goes up by one per message. A
+client that sees a gap (a delta the server dropped while it was behind)
+subscribes again by itself, and the fresh snapshot comes through like any
+other message.
+
+ClientPool does the same across the sockets of many daemons. On Python 3
+the asyncio based ClientProtocol resolves a Future per request instead.
+"""
+import sys, socket, select, itertools, msgpack
+from collections import deque
+from time        import time
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+def _unpacker():
+    if sys.version_info[0] >= 3: return(msgpack.Unpacker(raw=False))
+    return(msgpack.Unpacker())
+
+def _request(request_id, action, data, machine):
+    request = {'action': action, 'data': data, 'id': request_id}
+    if machine is not None: request['machine'] = machine
+    return(msgpack.packb(request))
+
+class BurijjiError(Exception):
+    """The server answered a request with one of its *_error actions."""
+
+    def __init__(self, reply):
+        Exception.__init__(self, reply.get('action') + ': ' + str(reply.get('data')))
+        self.reply = reply
+
+def _check(reply):
+    if reply.get('action', '').endswith('_error'): raise BurijjiError(reply)
+    return(reply)
+
+def _gap(versions, message):
+    """Whether `message` is a delta that doesn't follow the last version seen
+    for its machine and kind in `versions`, which it updates."""
+    if type(message) is not dict or 'version' not in message: return(False)
+    key           = (message.get('machine'), message.get('action'))
+    previous      = versions.get(key)
+    versions[key] = message['version']
+    return(bool(message.get('delta')) and previous is not None and message['version'] != previous + 1)
+
+def _resubscribe(message):
+    return(('subscribe', {'type': message.get('action'), 'delta': True}, message.get('machine')))
+
+class Client:
+    """Blocking client for one BurijjiServer socket.
+
+    send() returns the id of a request without waiting for it, wait() blocks
+    until the reply with that id arrives; request() does both. Everything
+    that isn't a reply being waited for is kept for messages().
+    """
+
+    def __init__(self, path, timeout=10.0):
+        self.path      = path
+        self.timeout   = timeout
+        self._socket   = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._unpacker = _unpacker()
+        self._ids      = itertools.count(1)
+        self._waiting  = set()
+        self._replies  = {}
+        self._streamed = set()
+        self._messages = deque()
+        self._versions = {}
+        self._resyncs  = {}
+        self.closed    = False
+
+    def fileno(self):
+        return(self._socket.fileno())
+
+    def send(self, action, data='', machine=None):
+        request_id = next(self._ids)
+        self._waiting.add(request_id)
+        self._socket.sendall(_request(request_id, action, data, machine))
+        return(request_id)
+
+    def wait(self, request_id, timeout=None):
+        """The reply to request_id. Raises BurijjiError for error replies and
+        socket.timeout if none came within the timeout."""
+        deadline = time() + (self.timeout if timeout is None else timeout)
+        while request_id not in self._replies:
+            if self.closed: raise socket.error('Connection closed by the server')
+            if not self.read(deadline - time()): raise socket.timeout('No reply to request ' + str(request_id))
+        self._waiting.discard(request_id)
+        return(_check(self._replies.pop(request_id)))
+
+    def request(self, action, data='', machine=None, timeout=None):
+        return(self.wait(self.send(action, data, machine), timeout))
+
+    def pipeline(self, requests, timeout=None):
+        """Sends every (action, data[, machine]) before waiting for any reply."""
+        ids = [self.send(*request) for request in requests]
+        return([self.wait(request_id, timeout) for request_id in ids])
+
+    def subscribe(self, subscription='all', machine=None, delta=False):
+        data       = {'type': subscription, 'delta': True} if delta else {'type': subscription}
+        request_id = self.send('subscribe', data, machine)
+        # Delta subscriptions reply with their first snapshot, which belongs to the stream too.
+        self._streamed.add(request_id)
+        try:
+            return(self.wait(request_id))
+        finally:
+            self._streamed.discard(request_id)
+
+    def unsubscribe(self, subscription='all', machine=None):
+        return(self.request('unsubscribe', {'type': subscription}, machine))
+
+    def messages(self, timeout=None):
+        """Yields subscription and other unrequested messages as they arrive,
+        until nothing came for `timeout` seconds (forever if None) or the
+        connection closed."""
+        while True:
+            while self._messages: yield self._messages.popleft()
+            if self.closed or not self.read(timeout): return
+
+    def read(self, timeout=None):
+        """Reads whatever arrives within `timeout`, returning whether anything did."""
+        if timeout is not None and timeout < 0: timeout = 0
+        if not select.select([self._socket], [], [], timeout)[0]: return(False)
+        data = self._socket.recv(65536)
+        if not data:
+            self.closed = True
+            return(False)
+        self._unpacker.feed(data)
+        for message in self._unpacker:
+            if _gap(self._versions, message): self._resync(message)
+            request_id = message.get('id') if type(message) is dict else None
+            if request_id in self._resyncs:
+                # Nobody waits for a resubscribe, its snapshot is just another message.
+                del self._resyncs[request_id]
+                self._waiting.discard(request_id)
+                if message.get('action') != 'ack': self._messages.append(message)
+                continue
+            if request_id in self._waiting and request_id not in self._replies:
+                self._replies[request_id] = message
+                if request_id not in self._streamed or message.get('action') == 'ack': continue
+            self._messages.append(message)
+        return(True)
+
+    def _resync(self, message):
+        key = (message.get('machine'), message.get('action'))
+        if key not in self._resyncs.values(): self._resyncs[self.send(*_resubscribe(message))] = key
+
+    def close(self):
+        self.closed = True
+        self._socket.close()
+
+class ClientPool:
+    """Clients for the sockets of many daemons, connected on first use.
+
+    request_all() pipelines one request to every socket before waiting for
+    the replies, messages() streams what all of them send, tagged with the
+    socket it came from.
+    """
+
+    def __init__(self, paths, timeout=10.0):
+        self.timeout  = timeout
+        self._paths   = list(paths)
+        self._clients = {}
+
+    def client(self, path):
+        if path not in self._clients or self._clients[path].closed:
+            self._clients[path] = Client(path, self.timeout)
+        return(self._clients[path])
+
+    def request(self, path, action, data='', machine=None, timeout=None):
+        return(self.client(path).request(action, data, machine, timeout))
+
+    def request_all(self, action, data='', machine=None, timeout=None):
+        """{path: reply} for every socket, or {path: exception} where it failed."""
+        sent    = {}
+        replies = {}
+        for path in self._paths:
+            try:
+                sent[path] = self.client(path).send(action, data, machine)
+            except (socket.error, BurijjiError) as e:
+                replies[path] = e
+        for path, request_id in sent.items():
+            try:
+                replies[path] = self._clients[path].wait(request_id, timeout)
+            except (socket.error, BurijjiError) as e:
+                replies[path] = e
+        return(replies)
+
+    def subscribe_all(self, subscription='all', delta=False):
+        """{path: reply} like request_all(), one socket after the other."""
+        replies = {}
+        for path in self._paths:
+            try:
+                replies[path] = self.client(path).subscribe(subscription, delta=delta)
+            except (socket.error, BurijjiError) as e:
+                replies[path] = e
+        return(replies)
+
+    def messages(self, timeout=None):
+        """Yields (path, message) from every connected socket."""
+        while True:
+            clients = [client for client in self._clients.values() if not client.closed]
+            for client in clients:
+                while client._messages: yield (client.path, client._messages.popleft())
+            if not clients: return
+            readable = select.select(clients, [], [], timeout)[0]
+            if not readable: return
+            for client in readable: client.read(0)
+
+    def close(self):
+        for client in self._clients.values(): client.close()
+        self._clients.clear()
+
+if asyncio is not None:
+    class ClientProtocol(asyncio.Protocol):
+        """asyncio client: request() returns a Future resolved with the reply,
+        everything else goes to on_message. Kept to Python 2 syntax, this
+        module is shared with the daemon.
+
+            transport, client = loop.run_until_complete(connect(path, loop, on_message))
+            reply = loop.run_until_complete(client.request('machine_info'))
+        """
+
+        def __init__(self, on_message=None, loop=None):
+            self.on_message = on_message
+            self.transport  = None
+            self._loop      = loop
+            self._unpacker  = _unpacker()
+            self._ids       = itertools.count(1)
+            self._pending   = {}
+            self._versions  = {}
+            self._resyncs   = set()
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self._unpacker.feed(data)
+            for message in self._unpacker:
+                if _gap(self._versions, message): self._resync(message)
+                future = self._pending.pop(message.get('id'), None) if type(message) is dict else None
+                if future is None:
+                    if self.on_message is not None: self.on_message(message)
+                elif not future.done():
+                    if message.get('action', '').endswith('_error'): future.set_exception(BurijjiError(message))
+                    else:                                             future.set_result(message)
+
+        def connection_lost(self, exc):
+            for future in self._pending.values():
+                if not future.done(): future.set_exception(exc or ConnectionError('Connection closed by the server'))
+            self._pending.clear()
+
+        def request(self, action, data='', machine=None):
+            request_id = next(self._ids)
+            future     = (self._loop or asyncio.get_event_loop()).create_future()
+            self._pending[request_id] = future
+            self.transport.write(_request(request_id, action, data, machine))
+            return(future)
+
+        def subscribe(self, subscription='all', machine=None, delta=False):
+            data   = {'type': subscription, 'delta': True} if delta else {'type': subscription}
+            future = self.request('subscribe', data, machine)
+            # Delta subscriptions reply with their first snapshot, which belongs to the stream too.
+            future.add_done_callback(self._stream_snapshot)
+            return(future)
+
+        def _resync(self, message):
+            key = (message.get('machine'), message.get('action'))
+            if key in self._resyncs: return
+            self._resyncs.add(key)
+            def resynced(future):
+                self._resyncs.discard(key)
+                self._stream_snapshot(future)
+            self.request(*_resubscribe(message)).add_done_callback(resynced)
+
+        def _stream_snapshot(self, future):
+            if future.cancelled() or future.exception() is not None or self.on_message is None: return
+            if future.result().get('action') != 'ack': self.on_message(future.result())
+
+    def connect(path, loop=None, on_message=None):
+        """Future of (transport, ClientProtocol) connected to `path`."""
+        loop = loop or asyncio.get_event_loop()
+        return(loop.create_unix_connection(lambda: ClientProtocol(on_message, loop), path))
@@ -0,0 +1,95 @@
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from gcodesource import GCodeIndex
+
+class GCodeCache:
+    """GCodeIndex files on disk, keyed by a hash of the G-code content and its
+    mtime, so repeat jobs skip the indexing pass. Entries are touched when
+    used and the least recently used ones are evicted past max_bytes.
+
+    Content hashes are remembered for the memo_size most recently used
+    paths, as long as their size and mtime stay the same. Big files are
+    indexed by the worker processes of `pool`, if there is one."""
+    memo_size = 256
+
+    def __init__(self, directory, pool=None, max_bytes=256 << 20):
+        self.directory = directory
+        self.pool      = pool
+        self.max_bytes = max_bytes
+        self._hashes   = OrderedDict()
+        self._lock     = threading.Lock()
+
+    def key(self, path):
+        stat = os.stat(path)
+        memo = (stat.st_size, stat.st_mtime)
+        with self._lock:
+            cached = self._hashes.pop(path, None)
+            if cached is not None and cached[0] == memo:
+                self._hashes[path] = cached
+                return(cached[1])
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''): digest.update(chunk)
+        digest.update(repr(stat.st_mtime))
+        key = digest.hexdigest()
+
+        with self._lock:
+            self._hashes[path] = (memo, key)
+            while len(self._hashes) > self.memo_size: self._hashes.popitem(last=False)
+        return(key)
+
+    def load(self, path):
+        entry = os.path.join(self.directory, self.key(path) + '.idx')
+        try:
+            with open(entry, 'rb') as f:
+                index = GCodeIndex.load(f)
+            os.utime(entry, None)
+            return(index)
+        except (IOError, OSError, ValueError, EOFError):
+            return(None)
+
+    def store(self, path, index):
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+        fd, temp = tempfile.mkstemp('.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                index.dump(f)
+            os.rename(temp, os.path.join(self.directory, self.key(path) + '.idx'))
+        finally:
+            if os.path.exists(temp): os.remove(temp)
+        self._evict()
+
+    def index_for(self, path):
+        """Cached index of `path`, building and storing it on a miss."""
+        index = self.load(path)
+        if index is None:
+            index = GCodeIndex.build(path, self.pool)
+            try:
+                self.store(path, index)
+            except (IOError, OSError) as e:
+                print "GCodeCache: could not store index for '" + path + "'", e
+        return(index)
+
+    def _evict(self):
+        evict(self.directory, '.idx', self.max_bytes)
+
+def evict(directory, suffix, max_bytes):
+    """Removes the least recently used `suffix` files in `directory` until
+    they add up to max_bytes or less."""
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(suffix): continue
+        stat = os.stat(os.path.join(directory, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes: break
+        try:
+            os.remove(os.path.join(directory, name))
+            total -= size
+        except OSError:
+            pass
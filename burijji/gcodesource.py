@@ -0,0 +1,448 @@
+import os
+import array
+import bisect
+import struct
+import threading
+from math import sqrt
+
+_read_size   = 1 << 20
+_warmup_size = 256 << 10
+_moves       = frozenset(['G0', 'G1', 'G00', 'G01', 'G2', 'G3', 'G02', 'G03'])
+
+class _Estimator:
+    """Walks G-code lines keeping a rough machine model, and samples the
+    cumulative print time, filament and layer before every `stride`-th line.
+
+    Moves take their trapezoidal time from the feedrate and the M204
+    acceleration, starting and ending at rest. Arcs count as straight moves
+    and heating waits as nothing, so estimates run a little short. A layer
+    starts whenever something is extruded above the last extruding height,
+    which keeps Z hops out of the count.
+    """
+    acceleration = 1500.0
+
+    def __init__(self, stride):
+        self.stride       = stride
+        self.elapsed      = 0.0
+        self.extruded     = 0.0
+        self.layer        = 0
+        self.times        = array.array('d')
+        self.filament     = array.array('d')
+        self.layers       = array.array('I')
+        self.heights      = array.array('f')
+        self._position    = (0.0, 0.0, 0.0, 0.0)
+        self._feedrate    = 25.0
+        self._relative    = False
+        self._relative_e  = False
+        self._scale       = 1.0
+        self._layer_z     = None
+        self._setpoints   = {}
+
+    def reset(self):
+        """Forgets totals and samples but keeps the machine state, after a
+        warm-up over the lines before a range indexed in a worker."""
+        self.elapsed  = 0.0
+        self.extruded = 0.0
+        self.layer    = 0
+        for samples in [self.times, self.filament, self.layers, self.heights]: del samples[:]
+
+    def feed(self, number, line):
+        if number % self.stride == 0:
+            self.times.append(self.elapsed)
+            self.filament.append(self.extruded)
+            self.layers.append(self.layer)
+            self.heights.append(self._position[2])
+
+        if ';' in line: line = line[:line.index(';')]
+        if '(' in line: line = line[:line.index('(')]
+        words = line.upper().split()
+        if words and words[0][0] == 'N': words = words[1:]
+        if not words: return
+        command = words[0]
+        if command in _moves: return(self._move(words))
+
+        params = {}
+        for word in words[1:]:
+            try:
+                params[word[0]] = float(word[1:])
+            except ValueError:
+                pass
+
+        if command in ('G4', 'G04'):
+            self.elapsed += params.get('P', 0.0) / 1000.0 + params.get('S', 0.0)
+        elif command == 'G90':
+            self._relative = self._relative_e = False
+        elif command == 'G91':
+            self._relative = self._relative_e = True
+        elif command == 'M82':
+            self._relative_e = False
+        elif command == 'M83':
+            self._relative_e = True
+        elif command == 'G92':
+            self._position = tuple(params[letter] * self._scale if letter in params else value for letter, value in zip('XYZE', self._position))
+        elif command == 'G28':
+            homed = [letter for letter in 'XYZ' if letter in params] or 'XYZ'
+            self._position = tuple(0.0 if letter in homed else value for letter, value in zip('XYZE', self._position))
+        elif command == 'G20':
+            self._scale = 25.4
+        elif command == 'G21':
+            self._scale = 1.0
+        elif command == 'M204':
+            acceleration = params.get('S', params.get('P'))
+            if acceleration: self.acceleration = acceleration
+        elif command in ('M104', 'M109'):
+            if 'S' in params: self._setpoints['t' + (str(int(params['T'])) if 'T' in params else '')] = params['S']
+        elif command in ('M140', 'M190'):
+            if 'S' in params: self._setpoints['b'] = params['S']
+
+    def state(self):
+        x, y, z, e = self._position
+        return({'x': x, 'y': y, 'z': z, 'e': e, 'feedrate': self._feedrate * 60.0, 'relative': self._relative,
+                'relative_e': self._relative_e, 'temperatures': dict(self._setpoints)})
+
+    def _move(self, words):
+        # The hot path, every printing line is a move: no dicts, no per-axis loops.
+        x, y, z, e     = self._position
+        tx, ty, tz, te = self._position
+        scale          = self._scale
+        relative       = self._relative
+        for word in words[1:]:
+            try:
+                value = float(word[1:]) * scale
+            except ValueError:
+                continue
+            letter = word[0]
+            if letter == 'X':   tx = value + x if relative else value
+            elif letter == 'Y': ty = value + y if relative else value
+            elif letter == 'Z': tz = value + z if relative else value
+            elif letter == 'E': te = value + e if self._relative_e else value
+            elif letter == 'F' and value > 0: self._feedrate = value / 60.0
+
+        dx, dy, dz, de = tx - x, ty - y, tz - z, te - e
+        distance = sqrt(dx * dx + dy * dy + dz * dz) or abs(de)
+        if distance:
+            # Accelerating to the feedrate and back takes feedrate**2 / acceleration mm.
+            speed, acceleration = self._feedrate, self.acceleration
+            if distance >= speed * speed / acceleration: self.elapsed += distance / speed + speed / acceleration
+            else:                                        self.elapsed += 2 * sqrt(distance / acceleration)
+        if de:
+            self.extruded += de
+            if de > 0 and (self._layer_z is None or tz > self._layer_z + 0.0001):
+                self.layer   += 1
+                self._layer_z = tz
+        self._position = (tx, ty, tz, te)
+
+def _scan(f, length, lines, last, stride, estimator=None):
+    """Reads `length` bytes from f's position, returning the offsets of lines
+    numbered as multiples of `stride`, the line count and the last byte read.
+    `lines` and `last` describe what came before the position. With an
+    estimator every line starting in the range is fed to it, reading on
+    past the range to finish the last one."""
+    offsets = array.array('L')
+    start   = f.tell()
+    carry   = None if last != '\n' else ''
+    while length > 0:
+        chunk = f.read(min(_read_size, length))
+        if not chunk: break
+        length -= len(chunk)
+        parts   = chunk.split('\n')
+        # parts[k] is line `lines + k`. The first one started in the previous
+        # chunk if that didn't end on a newline, an empty last one starts in the next.
+        first    = 0 if last == '\n' else 1
+        end      = len(parts) if parts[-1] else len(parts) - 1
+        k        = first + (-(lines + first) % stride)
+        position = 0
+        counted  = 0
+        while k < end:
+            position += sum(map(len, parts[counted:k])) + (k - counted)
+            counted   = k
+            offsets.append(start + position)
+            k        += stride
+
+        if estimator is not None:
+            # A carry of None is the tail of a line that began before the range.
+            if len(parts) == 1:
+                if carry is not None: carry += parts[0]
+            else:
+                if carry is not None: estimator.feed(lines, carry + parts[0])
+                for k in xrange(1, len(parts) - 1): estimator.feed(lines + k, parts[k])
+                carry = parts[-1]
+
+        lines += chunk.count('\n')
+        start += len(chunk)
+        last   = chunk[-1]
+    if estimator is not None and carry: estimator.feed(lines, carry + f.readline())
+    return(offsets, lines, last)
+
+def _count_newlines(args):
+    path, start, end = args
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            chunk  = f.read(min(_read_size, end - start))
+            if not chunk: break
+            count += chunk.count('\n')
+            start += len(chunk)
+    return(count)
+
+def _index_range(args):
+    path, start, end, lines, stride = args
+    estimator = _Estimator(stride)
+    with open(path, 'rb') as f:
+        if start:
+            # Replay what comes before the range to pick up positions, modes
+            # and the layer height, the line crossing `start` included.
+            warmup = min(start, _warmup_size)
+            f.seek(start - warmup)
+            text   = f.read(warmup)
+            last   = text[-1]
+            if last != '\n': text += f.readline()
+            before = text.split('\n')[(1 if warmup < start else 0):-1]
+            for line in before: estimator.feed(0, line)
+            estimator.reset()
+            f.seek(start)
+        else:
+            last = '\n'
+        offsets = _scan(f, end - start, lines, last, stride, estimator)[0]
+    return((offsets.tostring(), estimator.times.tostring(), estimator.filament.tostring(), estimator.layers.tostring(),
+            estimator.heights.tostring(), estimator.elapsed, estimator.extruded, estimator.layer))
+
+class GCodeIndex:
+    """Line count of a G-code file plus the byte offset of every `stride`-th
+    line, which is all GCodeSource needs to reach any line with one seek and
+    fewer than `stride` readline() calls.
+
+    Alongside each offset it keeps the estimated print time, filament used,
+    layer and Z reached before that line, so progress() can turn a line
+    number into time-based progress without reading the file."""
+    stride             = 256
+    parallel_threshold = 8 << 20
+    parallel_chunk     = 32 << 20
+    _magic     = 'BGCI'
+    _version   = 2
+    _header    = '<4sHBIQQddQ'
+
+    def __init__(self, line_count, offsets, stride=None, estimator=None):
+        self.line_count = line_count
+        self.offsets    = offsets
+        self.stride     = stride or self.stride
+        self.estimator  = estimator or _Estimator(self.stride)
+
+    @classmethod
+    def build(cls, path, pool=None):
+        """Indexes `path`, splitting big files into ranges scanned by the
+        worker processes of `pool` so the daemon's own threads never hold
+        the GIL for the whole file."""
+        size      = os.path.getsize(path)
+        estimator = _Estimator(cls.stride)
+        if pool is None or size < cls.parallel_threshold:
+            with open(path, 'rb') as f:
+                offsets, lines, last = _scan(f, size, 0, '\n', cls.stride, estimator)
+            if last != '\n': lines += 1
+            return(cls(lines, offsets, cls.stride, estimator))
+
+        # Line numbers at each range start come from a first pass counting
+        # newlines, the second pass records the offsets inside every range.
+        ranges  = [(path, start, min(start + cls.parallel_chunk, size)) for start in xrange(0, size, cls.parallel_chunk)]
+        counts  = pool.map(_count_newlines, ranges)
+        firsts  = [sum(counts[:i]) for i in xrange(len(counts))]
+        parts   = pool.map(_index_range, [(path, start, end, first, cls.stride) for (path, start, end), first in zip(ranges, firsts)])
+        offsets = array.array('L')
+        for part, times, filament, layers, heights, elapsed, extruded, layer in parts:
+            # Each range counted from zero, shift it by everything before it.
+            offsets.fromstring(part)
+            for samples, data, base in [(estimator.times, times, estimator.elapsed), (estimator.filament, filament, estimator.extruded),
+                                        (estimator.layers, layers, estimator.layer)]:
+                values = array.array(samples.typecode, data)
+                samples.extend(array.array(samples.typecode, [value + base for value in values]) if base else values)
+            estimator.heights.fromstring(heights)
+            estimator.elapsed  += elapsed
+            estimator.extruded += extruded
+            estimator.layer    += layer
+
+        lines = sum(counts)
+        with open(path, 'rb') as f:
+            f.seek(size - 1)
+            if f.read(1) != '\n': lines += 1
+        return(cls(lines, offsets, cls.stride, estimator))
+
+    def progress(self, line):
+        """Estimated progress once `line` has been sent: percent by time,
+        elapsed and remaining (eta) seconds, layer and filament used in mm.
+        Times between two samples are interpolated, the layer is the one at
+        the earlier sample."""
+        estimator = self.estimator
+        if not estimator.times or line is None or line < 0: return(None)
+        sample = min(line // self.stride, len(estimator.times) - 1)
+        if sample + 1 < len(estimator.times):
+            span, time, extruded = self.stride, estimator.times[sample + 1], estimator.filament[sample + 1]
+        else:
+            span, time, extruded = max(1, self.line_count - sample * self.stride), estimator.elapsed, estimator.extruded
+        fraction = min(1.0, (line - sample * self.stride) / float(span))
+        elapsed  = estimator.times[sample] + (time - estimator.times[sample]) * fraction
+        filament = estimator.filament[sample] + (extruded - estimator.filament[sample]) * fraction
+        total    = estimator.elapsed
+        return({'percent': round((100.0 * elapsed / total) if total else 100.0, 2), 'elapsed': int(elapsed), 'eta': int(max(0.0, total - elapsed)),
+                'layer': int(estimator.layers[sample]), 'layers': int(estimator.layer), 'z': round(estimator.heights[sample], 3), 'filament_used': round(filament, 1), 'filament_total': round(estimator.extruded, 1)})
+
+    def dump(self, f):
+        estimator = self.estimator
+        f.write(struct.pack(self._header, self._magic, self._version, self.offsets.itemsize, self.stride, self.line_count, len(self.offsets),
+                            estimator.elapsed, estimator.extruded, estimator.layer))
+        for samples in [self.offsets, estimator.times, estimator.filament, estimator.layers, estimator.heights]: samples.tofile(f)
+
+    @classmethod
+    def load(cls, f):
+        header = f.read(struct.calcsize(cls._header))
+        if len(header) != struct.calcsize(cls._header): raise ValueError('Truncated G-code index')
+        magic, version, itemsize, stride, line_count, count, elapsed, extruded, layer = struct.unpack(cls._header, header)
+        if magic != cls._magic or version != cls._version or itemsize != array.array('L').itemsize:
+            raise ValueError('Incompatible G-code index')
+        offsets   = array.array('L')
+        estimator = _Estimator(stride)
+        for samples in [offsets, estimator.times, estimator.filament, estimator.layers, estimator.heights]: samples.fromfile(f, count)
+        estimator.elapsed, estimator.extruded, estimator.layer = elapsed, extruded, layer
+        return(cls(line_count, offsets, stride, estimator))
+
+class _Line:
+    def __init__(self, raw):
+        self.raw = raw
+
+class _Layer:
+    def __init__(self, source):
+        self._source = source
+
+    def __getitem__(self, index):
+        return(_Line(self._source[index]))
+
+    def __len__(self):
+        return(len(self._source))
+
+class GCodeSource:
+    """Lazily read, stripped lines of a G-code file.
+
+    Memory stays flat whatever the file size: lines are read from disk when
+    asked for, sequential access costs one readline() per line and random
+    access seeks through the sparse GCodeIndex. Also quacks enough like a
+    gcoder.GCode (lines, idxs(), all_layers) for printcore.startprint().
+    """
+
+    def __init__(self, path, index=None):
+        self.path    = path
+        self.index   = index or GCodeIndex.build(path)
+        self._file   = open(path, 'rb')
+        self._lock   = threading.Lock()
+        self._next   = 0
+        self._recent = {}
+
+        self.lines      = self
+        self.all_layers = [_Layer(self)]
+
+    def __len__(self):
+        return(self.index.line_count)
+
+    def __getitem__(self, index):
+        if index < 0: index += self.index.line_count
+        if not 0 <= index < self.index.line_count: raise IndexError(index)
+
+        with self._lock:
+            # printcore looks one line back and one ahead of the one it sends.
+            if index in self._recent: return(self._recent[index])
+
+            stride = self.index.stride
+            if not (index // stride) * stride <= self._next <= index:
+                self._file.seek(self.index.offsets[index // stride])
+                self._next = (index // stride) * stride
+            while self._next < index:
+                self._file.readline()
+                self._next += 1
+            line        = self._file.readline().strip()
+            self._next += 1
+
+            if len(self._recent) > 4: self._recent.clear()
+            self._recent[index] = line
+            return(line)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for line in f: yield line.strip()
+
+    def iter_from(self, start):
+        """Iterates the lines from `start` on, seeking there through the index."""
+        if start >= self.index.line_count: return
+        stride = self.index.stride
+        with open(self.path, 'rb') as f:
+            f.seek(self.index.offsets[start // stride])
+            for skipped in xrange(start % stride): f.readline()
+            for line in f: yield line.strip()
+
+    def state_at(self, line):
+        """Machine state the file has set up just before `line`: position,
+        feedrate, modes and heater setpoints (see _Estimator.state()). Lines
+        are replayed from the first sample within _warmup_size bytes of it,
+        starting at the Z the index recorded there."""
+        index     = self.index
+        line      = min(line, index.line_count)
+        estimator = _Estimator(index.stride)
+        if not index.line_count: return(estimator.state())
+        sample    = min(line // index.stride, len(index.offsets) - 1)
+        first     = min(bisect.bisect_left(index.offsets, index.offsets[sample] - _warmup_size), sample)
+        estimator._position = (0.0, 0.0, float(index.estimator.heights[first]), 0.0)
+        with open(self.path, 'rb') as f:
+            f.seek(index.offsets[first])
+            for number in xrange(first * index.stride, line): estimator.feed(1, f.readline())
+        return(estimator.state())
+
+    def idxs(self, index):
+        return((0, index))
+
+    def line_at(self, index):
+        """The file line that line `index` of the job is."""
+        return(index)
+
+    def close(self):
+        self._file.close()
+
+class ResumedSource(GCodeSource):
+    """The lines of the GCodeSource `source` from `start` on, after the
+    `preamble` commands that bring the machine back to the state the file
+    had there. Started as one job, the preamble is paced by the firmware's
+    oks like the rest of it.
+    """
+
+    def __init__(self, source, preamble, start):
+        self.path     = source.path
+        self.index    = source.index
+        self.source   = source
+        self.preamble = list(preamble)
+        self.start    = min(start, len(source))
+
+        self.lines      = self
+        self.all_layers = [_Layer(self)]
+
+    def __len__(self):
+        return(len(self.preamble) + len(self.source) - self.start)
+
+    def __getitem__(self, index):
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError(index)
+        if index < len(self.preamble): return(self.preamble[index])
+        return(self.source[self.start + index - len(self.preamble)])
+
+    def __iter__(self):
+        for line in self.preamble: yield line
+        for line in self.source.iter_from(self.start): yield line
+
+    def iter_from(self, start):
+        for line in self.preamble[start:]: yield line
+        for line in self.source.iter_from(self.start + max(0, start - len(self.preamble))): yield line
+
+    def state_at(self, line):
+        return(self.source.state_at(line))
+
+    def line_at(self, index):
+        return(self.start + max(0, index - len(self.preamble)))
+
+    def close(self):
+        self.source.close()
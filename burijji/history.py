@@ -0,0 +1,76 @@
+import sys
+import array
+
+_nan = float('nan')
+
+class _Tier:
+    def __init__(self, step, slots):
+        self.step    = step
+        self.slots   = slots
+        self.latest  = None
+        self.values  = {}
+        self.sums    = {}
+        self.counts  = {}
+
+    def record(self, slot, temperatures):
+        if self.latest is not None and slot > self.latest:
+            # Blank whatever we skipped so stale laps of the ring read as gaps.
+            for values in self.values.itervalues():
+                for missed in xrange(self.latest + 1, min(slot, self.latest + 1 + self.slots)): values[missed % self.slots] = _nan
+            self.sums.clear()
+            self.counts.clear()
+        if self.latest is None or slot > self.latest: self.latest = slot
+
+        position = slot % self.slots
+        for heater, temperature in temperatures.iteritems():
+            if heater not in self.values: self.values[heater] = array.array('f', [_nan]) * self.slots
+            # Coarser tiers hold the mean of the samples that fell in the slot.
+            self.sums[heater]   = self.sums.get(heater, 0.0) + temperature
+            self.counts[heater] = self.counts.get(heater, 0) + 1
+            self.values[heater][position] = self.sums[heater] / self.counts[heater]
+
+    def read(self, heater, first, last):
+        values = self.values.get(heater)
+        result = array.array('f', [_nan]) * (last - first + 1)
+        if values is None: return(result)
+        oldest = self.latest - self.slots + 1
+        for slot in xrange(max(first, oldest), min(last, self.latest) + 1): result[slot - first] = values[slot % self.slots]
+        return(result)
+
+class TemperatureHistory:
+    """Fixed-memory history of every heater's temperature.
+
+    Samples go into float32 rings at 1 s resolution for 3 hours, 10 s for
+    12 hours and 1 min for a week, about 100 KB per heater in total. Only
+    touched from the server loop, so there is no locking.
+    """
+    tiers = [(1, 3 * 3600), (10, 12 * 360), (60, 7 * 24 * 60)]
+
+    def __init__(self):
+        self._tiers = [_Tier(step, slots) for step, slots in self.tiers]
+
+    def record(self, timestamp, temperatures):
+        if not temperatures: return
+        for tier in self._tiers: tier.record(int(timestamp) // tier.step, temperatures)
+
+    def heaters(self):
+        return(sorted(self._tiers[0].values.keys()))
+
+    def query(self, start, end, heaters=None):
+        """Returns (first, step, count, heaters, values) for [start, end] from the
+        finest tier reaching back to start. values is one little-endian float32
+        block, heater after heater, with NaN where nothing was recorded."""
+        heaters = heaters or self.heaters()
+        tier    = self._tiers[-1]
+        for candidate in self._tiers:
+            if candidate.latest is not None and int(start) // candidate.step > candidate.latest - candidate.slots:
+                tier = candidate
+                break
+
+        first  = int(start) // tier.step
+        last   = max(first, int(end) // tier.step)
+        first  = max(first, last - tier.slots + 1)
+        values = array.array('f')
+        for heater in heaters: values.extend(tier.read(heater, first, last))
+        if sys.byteorder == 'big': values.byteswap()
+        return(first * tier.step, tier.step, last - first + 1, heaters, values.tostring())
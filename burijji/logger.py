@@ -0,0 +1,135 @@
+import os, sys, atexit, threading
+from collections import deque
+from time        import time, strftime, localtime
+
+TRACE, DEBUG, INFO, WARNING, ERROR = 5, 10, 20, 30, 40
+_level_names  = {TRACE: 'trace', DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+_level_values = dict((name, level) for level, name in _level_names.iteritems())
+
+class Logger:
+    """Leveled logging that never writes from the caller's thread.
+
+    Events go onto a deque (append is atomic under the GIL, no lock taken)
+    and a daemon thread writes them out in batches with one flush per batch,
+    so a slow stdout pipe can't stall the serial threads. Messages are only
+    formatted by the writer.
+
+    Every category has its own threshold, falling back to `level`. Serial
+    traffic is logged at TRACE under 'serial', which is off by default; it
+    is always kept in a small per-machine ring though, and dump_traffic()
+    writes that ring out when something goes wrong. Thresholds come from
+    BURIJJI_LOG, e.g. BURIJJI_LOG="info,serial=trace,print=debug".
+
+    At most max_events wait for the writer. If it falls that far behind the
+    oldest events are dropped, and the writer says how many it lost.
+    """
+    flush_interval = 0.25
+    traffic_lines  = 500
+    max_events     = 100000
+
+    def __init__(self, stream=None, config=None):
+        self.stream      = stream
+        self.level       = INFO
+        self._thresholds = {}
+        self._events     = deque(maxlen=self.max_events)
+        self.dropped     = 0
+        self._traffic    = {}
+        self._urgent     = threading.Event()
+        self._writer     = None
+        self._writer_lock = threading.Lock()
+        if config: self.configure(config)
+
+    def configure(self, config):
+        for setting in config.split(','):
+            category, _, level = setting.strip().rpartition('=')
+            if level not in _level_values: continue
+            if category: self._thresholds[category] = _level_values[level]
+            else:        self.level = _level_values[level]
+
+    def set_level(self, category, level):
+        self._thresholds[category] = _level_values.get(level, level)
+
+    def enabled(self, category, level):
+        return(level >= self._thresholds.get(category, self.level))
+
+    def log(self, category, level, message, *args):
+        if level < self._thresholds.get(category, self.level): return
+        self._append((time(), level, category, message, args))
+        if self._writer is None: self._start()
+        if level >= ERROR: self._urgent.set()
+
+    def trace(self, category, message, *args):   self.log(category, TRACE, message, *args)
+    def debug(self, category, message, *args):   self.log(category, DEBUG, message, *args)
+    def info(self, category, message, *args):    self.log(category, INFO, message, *args)
+    def warning(self, category, message, *args): self.log(category, WARNING, message, *args)
+    def error(self, category, message, *args):   self.log(category, ERROR, message, *args)
+
+    def traffic(self, source, direction, line):
+        """Records one line sent ('>') to or received ('<') from `source`, or
+        logged ('!') by the program talking to it."""
+        ring = self._traffic.get(source)
+        if ring is None: ring = self._traffic.setdefault(source, deque(maxlen=self.traffic_lines))
+        ring.append((time(), direction, line))
+        if TRACE >= self._thresholds.get('serial', self.level):
+            self._append((time(), TRACE, 'serial', '%s %s %s', (source, direction, line)))
+            if self._writer is None: self._start()
+
+    def dump_traffic(self, source, reason):
+        ring = list(self._traffic.get(source, ()))
+        self.log('serial', ERROR, "%s: %s, last %d lines of traffic follow", source, reason, len(ring))
+        for timestamp, direction, line in ring:
+            self._append((timestamp, ERROR, 'serial', '%s %s %s', (source, direction, line)))
+        self._urgent.set()
+
+    def _append(self, event):
+        events = self._events
+        if len(events) == events.maxlen: self.dropped += 1
+        events.append(event)
+
+    def flush(self):
+        with self._writer_lock:
+            self._write()
+
+    def _start(self):
+        with self._writer_lock:
+            if self._writer is not None: return
+            self._writer = threading.Thread(target=self._run, name='burijji-logger')
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _run(self):
+        while True:
+            self._urgent.wait(self.flush_interval)
+            self._urgent.clear()
+            with self._writer_lock:
+                self._write()
+
+    def _write(self):
+        events  = self._events
+        lines   = []
+        dropped = self.dropped
+        if dropped:
+            self.dropped -= dropped
+            lines.append(self._format(time(), WARNING, 'log', '%d events dropped, the writer fell behind' % dropped))
+        while events:
+            timestamp, level, category, message, args = events.popleft()
+            if args:
+                try:
+                    message = message % args
+                except (TypeError, ValueError):
+                    message = message + ' ' + repr(args)
+            lines.append(self._format(timestamp, level, category, message))
+        if not lines: return
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(''.join(lines))
+            stream.flush()
+        except (IOError, ValueError):
+            pass
+
+    def _format(self, timestamp, level, category, message):
+        return('%s.%03d %-7s %-6s %s\n' % (strftime('%H:%M:%S', localtime(timestamp)), int(timestamp * 1000) % 1000,
+                                           _level_names.get(level, level), category, str(message).rstrip()))
+
+log = Logger(config=os.environ.get('BURIJJI_LOG'))
+atexit.register(log.flush)
@@ -1,22 +1,44 @@
-from time                   import sleep
 from collections            import deque
+import os
+from state                  import VersionedState
+from gcodesource            import GCodeSource, ResumedSource
+from checkpoint             import Checkpoint, resume_commands
+from history                import TemperatureHistory
 import threading
-import re
+from metrics                import Histogram, TimedLock
+from responses              import GPXResponseParser
+from logger                 import log
+from time                   import time
 import subprocess
 from x3g import X3GPrinter
+from x3gjob                 import X3GJob
 
 class mbWrapper:
-    _temp_exp = re.compile("([TB]\d*) temperature: ([-+]?\d*\.?\d*)c")
-    _uuid_exp = re.compile("UUID:([0-F]{8}-[0-F]{4}-4[0-F]{3}-[89AB][0-F]{3}-[0-F]{12})", re.I)
+    _poll_intervals = {'heating': 1, 'printing': 3, 'idle': 5}
 
-    def __init__(self, server, protocol):
+    def __init__(self, server, port, baud, protocol):
         self._server           = server
-        self._mutex            = threading.Lock()
+        self.port              = port
+        self.baud              = baud
+        self.protocol          = protocol['protocol']
+        self.machine_id        = port.split('/')[-1]
+        self.running           = True
+        self._mutex            = TimedLock()
         self._temp_subscribers = []
         self._info_subscribers = []
         self._raw_subscribers  = []
+        self._temp_delta_subscribers = []
+        self._info_delta_subscribers = []
+        self._temp_state       = VersionedState()
+        self._info_state       = VersionedState()
+        self._history          = TemperatureHistory()
+        self._parser           = GPXResponseParser()
         self._temperatures     = {}
+        self._polled_temperatures = {}
         self._current_line     = None
+        self._progress         = None
+        self._index            = None
+        self._job              = None
         self._printing         = False
         self._paused           = False
         self._ok               = True
@@ -27,78 +49,157 @@ class mbWrapper:
         self._machine_info     = {'type': 'MakerBot', 'model':  'Unknown', 'uuid': None}
         self._current_segment  = 'none'
         self._gcode_file       = None
-        self.__printer = X3GPrinter(baud=self._server.baud, port=self._server.port, settings=protocol['x3g_settings'])
+        self._interrupted      = None
+        # Time the stop handlers take on the loop, priority_latency has the time to gpx's ok.
+        self._stop_call_time   = {'emergency_stop': Histogram(), 'stop_print': Histogram()}
+        self._checkpoint       = Checkpoint(os.path.join(server.checkpoint_dir, self.machine_id + '.json'))
+        # With precompile set, jobs are compiled to x3g up front and streamed
+        # to the bot instead of going through gpx line by line.
+        self._precompile       = protocol['x3g_settings'].get('precompile') == 'true'
+        self.__printer = X3GPrinter(baud=self.baud, port=self.port, settings=protocol['x3g_settings'])
 
     def start(self):
-        threading.Thread(target=self._update).start()
-        threading.Thread(target=self._run).start()
+        # Reported in machine_info and every info message until another job
+        # (or this one, resumed) starts printing.
+        self._interrupted = self._checkpoint.load()
+        printer = self.__printer
+        printer.on_receive     = self._parse_lines
+        printer.on_diagnostics = self._parse_diagnostics
+        printer.on_segment_end  = self._advance_segment
+        self._server.call_later(3, self._identify)
+        self._server.call_later(1, self._run)
+
+    def stop(self):
+        if not self.running: return
+        self.running = False
+        self.__printer.stop()
 
     def _run(self):
-        while self._server.running:
-            sleep(1)
+        if not (self.running and self._server.running): return
 
-            self._mutex.acquire()
-            temp_msg         = {'action': 'temperature', 'data': self._temperatures}
-            info_msg         = {'action': 'info', 'data': {'current_line': self._current_line, 'printing': self._printing, 'paused': self._paused, 'machine_info': self._machine_info, 'current_segment': self._current_segment}}
-            temp_subscribers = self._temp_subscribers
-            info_subscribers = self._info_subscribers
-            raw_subscribers  = self._raw_subscribers
-            ok               = self._ok
-            raw_output       = list(self._raw_output)
-            other_messages   = list(self._other_messages)
-            self._raw_output.clear()
-            self._other_messages.clear()
-            self._mutex.release()
-
-            if not self._ok:
-              print "burijji: disconnected"
-              other_messages.append({'action': 'disconnected'})
-
-            for fileno in temp_subscribers: self._server.add_to_queue(fileno, temp_msg)
-            for fileno in info_subscribers:
-                self._server.add_to_queue(fileno, info_msg)
-                for message in other_messages:
-                    self._server.add_to_queue(fileno, message)
-            for fileno in raw_subscribers:
-                for line in raw_output:
-                    self._server.add_to_queue(fileno, {'action': 'raw', 'data': line})
-
-            if not self._ok:
-              self._server.stop()
+        self._mutex.acquire()
+        info_data        = {'current_line': self._current_line, 'printing': self._printing, 'paused': self._paused, 'machine_info': self._machine_info,
+                            'current_segment': self._current_segment, 'progress': self._progress, 'print_interrupted': self._interrupted}
+        temp_msg         = {'action': 'temperature', 'machine': self.machine_id, 'data': self._temperatures}
+        info_msg         = {'action': 'info', 'machine': self.machine_id, 'data': info_data}
+        temp_changes     = self._temp_state.update(self._temperatures)
+        info_changes     = self._info_state.update(info_data)
+        temp_delta_msg   = {'action': 'temperature', 'machine': self.machine_id, 'data': temp_changes, 'version': self._temp_state.version, 'delta': True}
+        info_delta_msg   = {'action': 'info', 'machine': self.machine_id, 'data': info_changes, 'version': self._info_state.version, 'delta': True}
+        temp_subscribers = list(self._temp_subscribers)
+        info_subscribers = list(self._info_subscribers)
+        raw_subscribers  = list(self._raw_subscribers)
+        temp_delta_subscribers = list(self._temp_delta_subscribers)
+        info_delta_subscribers = list(self._info_delta_subscribers)
+        ok               = self._ok
+        temperatures     = dict(self._temperatures)
+        raw_output       = list(self._raw_output)
+        other_messages   = list(self._other_messages)
+        self._raw_output.clear()
+        self._other_messages.clear()
+        self._mutex.release()
 
-    def _update(self):
-        printer = self.__printer
-        printer.on_receive = self._parse_line
-        printer.on_segment_end  = self._advance_segment
-        sleep(3)
+        if not self._ok:
+          log.warning('printer', "%s: disconnected", self.machine_id)
+          other_messages.append({'action': 'disconnected', 'machine': self.machine_id})
+
+        self._history.record(time(), temperatures)
+        self._server.broadcast(temp_subscribers, temp_msg, 'temperature')
+        self._server.broadcast(info_subscribers, info_msg, 'info')
+        if temp_changes: self._server.broadcast(temp_delta_subscribers, temp_delta_msg, 'temperature_delta')
+        if info_changes: self._server.broadcast(info_delta_subscribers, info_delta_msg, 'info_delta')
+        for message in other_messages: self._server.broadcast(info_subscribers + info_delta_subscribers, message)
+        if raw_subscribers:
+            for line in raw_output: self._server.broadcast(raw_subscribers, {'action': 'raw', 'machine': self.machine_id, 'data': line}, 'raw')
+
+        if not self._ok:
+          self._server.remove_machine(self.port)
+        else:
+          self._server.call_later(1, self._run)
+
+    def stats(self):
+        stats = self.__printer.stats()
+        stats['lock_wait']['state'] = self._mutex.wait.report()
+        stats['stop_call_time']     = dict((kind, latency.report()) for kind, latency in self._stop_call_time.iteritems())
+        return(stats)
+
+    def _identify(self):
+        self.__printer.send_now(['M115', 'M112', 'M114'])
+        self._server.call_later(1, self._update)
+        self._server.call_later(1, self._poll)
+
+    def _poll(self):
+        if not (self.running and self._server.running): return
+        interval = self._poll_interval()
+        self.__printer.send_now('M105')
+        self._server.call_later(interval, self._poll)
+
+    def _poll_interval(self):
+        # gpx doesn't report setpoints, so a heater still moving is what marks heating.
+        self._mutex.acquire()
+        temperatures = dict(self._temperatures)
+        previous     = self._polled_temperatures
+        printing     = self._printing
+        self._polled_temperatures = temperatures
+        self._mutex.release()
+
+        if any(abs(temperature - previous.get(heater, temperature)) > 1 for heater, temperature in temperatures.iteritems()):
+            return(self._poll_intervals['heating'])
+        if printing: return(self._poll_intervals['printing'])
+        return(self._poll_intervals['idle'])
 
-        printer.send_now(['M115', 'M112', 'M114'])
+    def _acknowledged_line(self):
+        index = self.__printer.acknowledged_index
+        return(self._job.line_at(index) if self._job else index)
 
-        while self._server.running:
-            sleep(1)
-            printer.send_now('M105')
+    def _save_checkpoint(self):
+        # The line to resume from is the first one gpx hasn't acknowledged.
+        progress = self._progress or {}
+        line     = self._acknowledged_line()
+        self._mutex.acquire()
+        state    = {'file': self._gcode_file, 'line': line, 'segment': self._current_segment, 'z': progress.get('z'),
+                    'e': progress.get('filament_used'), 'temperatures': dict(self._temperatures)}
+        self._mutex.release()
+        self._checkpoint.save(state, time())
 
-            self._current_line = printer.queueindex
-            self._printing     = printer.printing
-            self._paused       = False
+    def _update(self):
+        if not (self.running and self._server.running): return
+        printer = self.__printer
 
-            if printer.ok == False:
-              self._ok = False
+        self._current_line = self._job.line_at(printer.queueindex) if self._job else printer.queueindex
+        self._progress     = self._index.progress(self._current_line) if self._index else None
+        self._printing     = printer.printing
+        self._paused       = False
 
-        printer.stop()
+        if printer.ok == False:
+          self._ok = False
+        if self._index and self._current_segment == 'printing': self._save_checkpoint()
+        self._server.call_later(1, self._update)
 
     def machine_info(self, fileno, data):
-        self._server.add_to_queue(fileno, {'action': 'machine_info', 'data': self._machine_info})
+        self._server.add_to_queue(fileno, {'action': 'machine_info', 'machine': self.machine_id, 'data': dict(self._machine_info, print_interrupted=self._interrupted)})
+
+    def temperature_history(self, fileno, data):
+        if type(data) is not dict or 'start' not in data:
+            return(self.bad_data_sent(fileno))
+        try:
+            first, step, count, heaters, values = self._history.query(data['start'], data.get('end', time()), data.get('heaters'))
+        except (TypeError, ValueError):
+            return(self.bad_data_sent(fileno))
+        self._server.add_to_queue(fileno, {'action': 'temperature_history', 'machine': self.machine_id,
+                                           'data': {'start': first, 'step': step, 'count': count, 'heaters': heaters, 'encoding': 'float32le', 'values': values}})
 
     def send_commands(self, fileno, data):
-        if type(data) is list:
+        if type(data) is list and all(isinstance(command, basestring) for command in data):
             self._send_commands(data)
         else:
             self.bad_data_sent(fileno)
 
     def print_file(self, fileno, data):
+        if not isinstance(data, basestring): return(self.bad_data_sent(fileno))
+        if not self._readable(fileno, data): return
         self._mutex.acquire()
-        if fileno not in self._info_subscribers: self._info_subscribers.append(fileno)
+        if fileno not in self._info_subscribers and fileno not in self._info_delta_subscribers: self._info_subscribers.append(fileno)
         self._mutex.release()
 
         self.add_other_message({'action': 'print_started', 'data': ''})
@@ -106,10 +207,29 @@ class mbWrapper:
         self._advance_segment()
 
     def stop_print(self, fileno, data):
+        requested = time()
         self._stop_print()
+        self._stop_call_time['stop_print'].add(time() - requested)
         self.add_other_message({'action': 'print_stopped', 'data': ''})
 
+    def emergency_stop(self, fileno, data):
+        requested = time()
+        self.__printer.send_priority('M112')
+        self._stop_call_time['emergency_stop'].add(time() - requested)
+        # The bot has stopped, dropping the queue can take its time. The
+        # checkpoint is kept so the job can be resumed later.
+        self._server.call_soon(self._halt)
+
+    def _halt(self):
+        self.__printer.on_complete = None
+        self.__printer.end_print()
+        self._current_segment = 'none'
+        self._index           = None
+        self.add_other_message({'action': 'emergency_stopped', 'data': ''})
+
     def pause_print(self, fileno, data):
+        # A compiled job goes to the bot packet by packet, the pause routine would only run once it's over.
+        if self.__printer.streaming: return(self._stream_error(fileno, 'pause_error', "A precompiled job can't be paused."))
         if self._printing:
             self._pause_print()
             if 'pause_print' in self._routines: self._send_commands(self._routines['pause_print'])
@@ -118,15 +238,43 @@ class mbWrapper:
     def print_complete(self):
         self.__printer.on_complete = None
         self._current_segment  = 'none'
+        self._index            = None
+        self._checkpoint.clear()
         self.add_other_message({'action': 'print_complete', 'data': ''})
 
     def resume_print(self, fileno, data):
+        if self.__printer.streaming: return(self._stream_error(fileno, 'resume_error', "A precompiled job can't be resumed."))
         if self._paused:
             self.add_other_message({'action': 'print_resumed', 'data': ''})
             if 'resume' in self._routines: self._send_commands(self._routines['resume_print'])
             self._resume_print()
 
+    def resume_print_from(self, fileno, data):
+        # Without a file and line, pick up where the last checkpoint left off.
+        checkpoint = self._checkpoint.load() or {}
+        if data is None or data == '': data = {}
+        if type(data) is not dict: return(self.bad_data_sent(fileno))
+        path = data.get('file', checkpoint.get('file'))
+        line = data.get('line', checkpoint.get('line'))
+        if not isinstance(path, basestring) or type(line) not in (int, long) or line < 0: return(self.bad_data_sent(fileno))
+        if self._current_segment != 'none':
+            return(self._server.add_to_queue(fileno, {'action': 'resume_error', 'machine': self.machine_id, 'data': 'Machine is already printing.'}))
+        if not self._readable(fileno, path): return
+
+        self._mutex.acquire()
+        if fileno not in self._info_subscribers and fileno not in self._info_delta_subscribers: self._info_subscribers.append(fileno)
+        self._mutex.release()
+
+        self.add_other_message({'action': 'print_resumed_from', 'data': {'file': path, 'line': line}})
+        self._gcode_file      = path
+        self._current_segment = 'printing'
+        threading.Thread(target=self._load_file, args=[path, line, checkpoint.get('targets')]).start()
+
+    def _stream_error(self, fileno, action, message):
+        self._server.add_to_queue(fileno, {'action': action, 'machine': self.machine_id, 'data': message})
+
     def run_routine(self, fileno, data):
+        if not isinstance(data, basestring): return(self.bad_data_sent(fileno))
         if data in self._routines:
             self._send_commands(self._routines[data])
         else: self._server.add_to_queue(fileno, {'action': 'routine_error', 'data': 'routine not defined'})
@@ -134,70 +282,77 @@ class mbWrapper:
     def update_routines(self, fileno, data):
         if type(data) is dict:
             for key,val in data.iteritems():
-                if type(val) is not list: return(self.bad_data_sent(fileno))
+                if type(val) is not list or not all(isinstance(command, basestring) for command in val): return(self.bad_data_sent(fileno))
             self._routines.update(data)
         else:
             self.bad_data_sent(fileno)
 
     def add_other_message(self, message):
+        message['machine'] = self.machine_id
         self._mutex.acquire()
         self._other_messages.append(message)
         self._mutex.release()
 
     def subscribe(self, fileno, data):
-        subscription = data['type']
+        if type(data) is not dict: return(self.bad_data_sent(fileno))
+        subscription = data.get('type')
         if subscription not in ['temperature','info','raw','all']:
             return(self._server.add_to_queue(fileno, {'action': 'data_error', 'data': 'Invalid subscription type.'}))
 
+        # Delta subscribers get a versioned snapshot now and changed fields afterwards.
+        delta = data.get('delta', False)
+        if delta:
+            temp_subscribers = self._temp_delta_subscribers
+            info_subscribers = self._info_delta_subscribers
+        else:
+            temp_subscribers = self._temp_subscribers
+            info_subscribers = self._info_subscribers
+
+        # Subscribing again (as delta clients do after a version gap) only sends a fresh snapshot.
         self._mutex.acquire()
-        if subscription == 'temperature':
-            self._temp_subscribers.append(fileno)
-        elif subscription == 'info':
-            self._info_subscribers.append(fileno)
-        elif subscription == 'raw':
-            self._raw_subscribers.append(fileno)
-        elif subscription == 'all':
-            self._temp_subscribers.append(fileno)
-            self._info_subscribers.append(fileno)
-            self._raw_subscribers.append(fileno)
+        if subscription in ['temperature', 'all']:
+            self._add(temp_subscribers, fileno)
+        if subscription in ['info', 'all']:
+            self._add(info_subscribers, fileno)
+        if subscription in ['raw', 'all']:
+            self._add(self._raw_subscribers, fileno)
+        snapshots = []
+        if delta and subscription in ['temperature', 'all']:
+            snapshots.append({'action': 'temperature', 'machine': self.machine_id, 'data': self._temp_state.snapshot(), 'version': self._temp_state.version})
+        if delta and subscription in ['info', 'all']:
+            snapshots.append({'action': 'info', 'machine': self.machine_id, 'data': self._info_state.snapshot(), 'version': self._info_state.version})
         self._mutex.release()
 
+        for snapshot in snapshots: self._server.add_to_queue(fileno, snapshot)
+
     def unsubscribe(self, fileno, data):
-        subscription = data['type']
+        if type(data) is not dict: return(self.bad_data_sent(fileno))
+        subscription = data.get('type')
         if subscription not in ['temperature','info','raw','all']:
             return(self._server.add_to_queue(fileno, {'action': 'data_error', 'data': 'Invalid subscription type.'}))
 
         self._mutex.acquire()
-        if subscription == 'temperature':
-            try:
-                self._temp_subscribers.remove(fileno)
-            except:
-                pass
-        elif subscription == 'info':
-            try:
-                self._info_subscribers.remove(fileno)
-            except:
-                pass
-        elif subscription == 'raw':
-            try:
-                self._raw_subscribers.remove(fileno)
-            except:
-                pass
-        else:
-            try:
-                self._temp_subscribers.remove(fileno)
-            except:
-                pass
-            try:
-                self._info_subscribers.remove(fileno)
-            except:
-                pass
-            try:
-                self._raw_subscribers.remove(fileno)
-            except:
-                pass
+        if subscription in ['temperature', 'all']:
+            self._discard(self._temp_subscribers, fileno)
+            self._discard(self._temp_delta_subscribers, fileno)
+        if subscription in ['info', 'all']:
+            self._discard(self._info_subscribers, fileno)
+            self._discard(self._info_delta_subscribers, fileno)
+        if subscription in ['raw', 'all']:
+            self._discard(self._raw_subscribers, fileno)
         self._mutex.release()
 
+    def _add(self, subscribers, fileno):
+        if fileno not in subscribers: subscribers.append(fileno)
+
+    def _discard(self, subscribers, fileno):
+        while fileno in subscribers: subscribers.remove(fileno)
+
+    def _readable(self, fileno, path):
+        if os.path.isfile(path) and os.access(path, os.R_OK): return(True)
+        self._server.add_to_queue(fileno, {'action': 'data_error', 'machine': self.machine_id, 'data': "Can't read '" + path + "'."})
+        return(False)
+
     def bad_data_sent(self, fileno):
         self._server.add_to_queue(fileno, {'action': 'data_error', 'data': 'Malformed data.'})
 
@@ -208,19 +363,19 @@ class mbWrapper:
         if self._current_segment == 'none':
             self._current_segment = 'starting'
             if 'start_print' in self._routines:
-                threading.Thread(target=self._delayed_start, args=[self._routines['start_print']]).start()
+                self._delayed_start(self._routines['start_print'])
             else:
                 self._advance_segment()
 
         elif self._current_segment == 'starting':
             self._current_segment = 'printing'
-            threading.Thread(target=self._delayed_start, args=[[i.strip() for i in open(self._gcode_file)]]).start()
+            threading.Thread(target=self._load_file, args=[self._gcode_file]).start()
             self.add_other_message({'action': 'segment_completed', 'data': 'start_segment'})
 
         elif self._current_segment == 'printing':
             self._current_segment = 'ending'
             if 'end_print' in self._routines:
-                threading.Thread(target=self._delayed_start, args=[self._routines['end_print']]).start()
+                self._delayed_start(self._routines['end_print'])
             else:
                 self._advance_segment()
             self.add_other_message({'action': 'segment_completed', 'data': 'print_segment'})
@@ -230,10 +385,46 @@ class mbWrapper:
             self._current_segment = 'none'
             self.add_other_message({'action': 'segment_completed', 'data': 'end_segment'})
 
+    def _load_file(self, path, start=0, targets=None):
+        # Indexing a whole job is too slow for the server loop.
+        try:
+            source = GCodeSource(path, self._server.gcode_cache.index_for(path))
+            # A job resumed part way is sent line by line, gpx has to be told
+            # where it is: the preamble goes first in the job, paced by oks.
+            if start: source = ResumedSource(source, resume_commands(source.state_at(start), targets, self._routines.get('resume_from')), start)
+            elif self._precompile: source = self._compile(source)
+        except Exception as e:
+            self._load_failed(path, e)
+            return
+        self._interrupted = None
+        self._delayed_start(source)
+
+    def _load_failed(self, path, error):
+        # Nothing would ever move the machine on from 'printing' otherwise.
+        log.error('print', "%s: could not load %s: %s", self.machine_id, path, error)
+        self._current_segment = 'none'
+        self._index           = None
+        self.add_other_message({'action': 'data_error', 'data': "Could not load '" + path + "': " + str(error)})
+
+    def _compile(self, source):
+        try:
+            return(self.__printer.compile(source, self._server.x3g_cache))
+        except (IOError, OSError, ValueError) as e:
+            log.warning('printer', "%s: could not compile %s, sending it line by line: %s", self.machine_id, source.path, e)
+            return(source)
+
     def _delayed_start(self, data):
-        sleep(0.1)
+        self._server.call_later(0.1, self._start_sending, data)
+
+    def _start_sending(self, data):
+        if not self.running: return
         self.__printer.on_complete  = self._advance_segment
-        self.__printer.send_many(data)
+        if isinstance(data, X3GJob): self.__printer.send_job(data)
+        else:                        self.__printer.send_many(data)
+        # Only the job itself has an index, routines report no progress. A
+        # streamed X3GJob reports source lines already.
+        self._index = data.index if isinstance(data, (GCodeSource, X3GJob)) else None
+        self._job   = data if isinstance(data, GCodeSource) else None
 
     def _end_print(self):
         if 'cancel_print' in self._routines: self._send_commands(self._routines['cancel_print'])
@@ -250,28 +441,18 @@ class mbWrapper:
     def _reumse_print(self):
         self.__printer.resume()
 
-    def _parse_line(self, line):
-        self._mutex.acquire()
-        self._raw_output.append(line)
-        self._mutex.release()
+    def _parse_diagnostics(self, lines):
+        # gpx's log, where temperatures and firmware info are reported, told apart from responses in the traffic.
+        self._parse_lines(lines, '!')
+
+    def _parse_lines(self, lines, direction='<'):
+        # X3GPrinter hands over whatever one read brought in, the mutex is taken once for all of it.
+        parsed = [self._parser.parse(line) for line in lines]
+        for line in lines: log.traffic(self.machine_id, direction, line)
 
-        temp_matches = self._temp_exp.findall(line)
-        temps        = dict((m[0].lower(), float(m[1])) for m in temp_matches)
         self._mutex.acquire()
-        self._temperatures.update(temps)
+        self._raw_output.extend(lines)
+        for kind, temperatures, targets, info in parsed:
+            if temperatures:       self._temperatures.update(temperatures)
+            if kind == 'firmware': self._machine_info.update(info)
         self._mutex.release()
-
-        if 'FIRMWARE' in line:
-            firmware_name  = line.split('FIRMWARE_NAME:')[1].split(';')[0]
-            machine_type   = line.split('MACHINE_TYPE:')[1].split()[0]
-            extruder_count = int(line.split('EXTRUDER_COUNT:')[1].split()[0])
-
-            uuid_match = self._uuid_exp.findall(line.lower())
-            if len(uuid_match): uuid = uuid_match[0]
-            else:               uuid = None
-
-            info_dict = {'firmware_name': firmware_name, 'machine_type': machine_type, 'extruder_count': extruder_count, 'uuid': uuid}
-            
-            self._mutex.acquire()
-            self._machine_info.update(info_dict)
-            self._mutex.release()
@@ -0,0 +1,86 @@
+import threading
+from time import time
+
+# Counters here are updated from several threads without locking. Under the
+# GIL the worst case is an occasional lost increment, which is fine for
+# monitoring and keeps the hot paths free of extra locks.
+
+class Histogram:
+    """Durations in fixed power-of-two microsecond buckets: bucket i counts
+    values below 2**i us, the last one everything above (about 67 s)."""
+
+    def __init__(self, buckets=27):
+        self.counts = [0] * buckets
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def add(self, seconds):
+        bucket = min(int(seconds * 1000000).bit_length(), len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.count          += 1
+        self.total          += seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, fraction):
+        if not self.count: return(0.0)
+        target = fraction * self.count
+        seen   = 0
+        # A bucket's upper bound, but never more than was actually seen.
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target: return(min((1 << bucket) / 1000000.0, self.max))
+        return(self.max)
+
+    def report(self):
+        return({'count': self.count, 'mean': (self.total / self.count) if self.count else 0.0, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99), 'buckets': list(self.counts)})
+
+class RateCounter:
+    """Events per second over the last `window` seconds, kept in a ring of per-second slots."""
+
+    def __init__(self, window=10):
+        self.total    = 0
+        self._window  = window
+        self._counts  = [0] * window
+        self._seconds = [0] * window
+
+    def add(self, count=1):
+        second = int(time())
+        slot   = second % self._window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot]  = 0
+        self._counts[slot] += count
+        self.total         += count
+
+    def rate(self):
+        # The current second is still filling up, average the full ones before it.
+        now    = int(time())
+        counts = [c for c, s in zip(self._counts, self._seconds) if now - self._window < s < now]
+        return(sum(counts) / float(self._window - 1))
+
+    def report(self):
+        return({'total': self.total, 'per_second': self.rate()})
+
+class TimedLock:
+    """threading.Lock that records how long callers waited to acquire it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait  = Histogram()
+
+    def acquire(self):
+        started = time()
+        self._lock.acquire()
+        self.wait.add(time() - started)
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return(self)
+
+    def __exit__(self, *exc):
+        self.release()
@@ -1,28 +1,62 @@
 from printrun.printcore     import printcore
 from printrun               import gcoder
-from time                   import sleep
 from collections            import deque
+import os
 import threading
-import re
-
-import sys
-
-def log(message):
-  print message
-  sys.stdout.flush()
+from state                  import VersionedState
+from gcodesource            import GCodeSource, ResumedSource
+from checkpoint             import Checkpoint, resume_commands
+from history                import TemperatureHistory
+from metrics                import Histogram, RateCounter, TimedLock
+from responses              import ResponseParser
+from logger                 import log, DEBUG
+from time                   import time
+
+class _printcore(printcore):
+    """printcore with its writes to the port under write_lock, which
+    repWrapper._write_now takes too: pyserial's write() can take several
+    os.write()s, two lines written at once could interleave."""
+
+    def __init__(self, *args, **kwargs):
+        printcore.__init__(self, *args, **kwargs)
+        self.write_lock = threading.Lock()
+
+    def _send(self, *args, **kwargs):
+        with self.write_lock:
+            return(printcore._send(self, *args, **kwargs))
 
 class repWrapper:
-    _temp_exp = re.compile("([TB]\d*):([-+]?\d*\.?\d*)")
-    _uuid_exp = re.compile("UUID:([0-F]{8}-[0-F]{4}-4[0-F]{3}-[89AB][0-F]{3}-[0-F]{12})", re.I)
+    _poll_intervals = {'heating': 1, 'printing': 3, 'idle': 5}
+    # Autoreport intervals without a temperature before M105 takes over.
+    _missed_reports = 3
 
-    def __init__(self, server):
+    def __init__(self, server, port, baud, protocol):
         self._server           = server
-        self._mutex            = threading.Lock()
+        self.port              = port
+        self.baud              = baud
+        self.protocol          = protocol['protocol']
+        self.machine_id        = port.split('/')[-1]
+        self.running           = True
+        self._mutex            = TimedLock()
         self._temp_subscribers = []
         self._info_subscribers = []
         self._raw_subscribers  = []
+        self._temp_delta_subscribers = []
+        self._info_delta_subscribers = []
+        self._temp_state       = VersionedState()
+        self._info_state       = VersionedState()
+        self._history          = TemperatureHistory()
+        self._parser           = ResponseParser()
         self._temperatures     = {}
+        self._targets          = {}
+        self._polled_temperatures = {}
+        self._autoreport       = False
+        self._autoreport_interval = None
+        self._reported_at      = 0
         self._current_line     = None
+        self._progress         = None
+        self._index            = None
+        self._job              = None
         self._printing         = False
         self._paused           = False
         self._ok               = True
@@ -30,98 +64,217 @@ class repWrapper:
         self._routines         = {}
         self._raw_output       = deque()
         self._other_messages   = deque()
-        self.__printer         = printcore()
+        self.__printer         = _printcore()
         self._machine_info     = {'type': 'RepRap', 'model':  'Unknown', 'uuid': None}
         self._current_segment  = 'none'
         self._gcode_file       = None
+        self._interrupted      = None
+        self._checkpoint       = Checkpoint(os.path.join(server.checkpoint_dir, self.machine_id + '.json'))
 
         self.__printer.errorcb = self.errorcb
         self.__printer.sendcb = self.sendcb
-        self.printer_lock = threading.Lock()
+        self.printer_lock = TimedLock()
+        self.connection_lock = threading.Lock()
+
+        self._lines_sent       = RateCounter()
+        self._ok_latency       = Histogram()
+        self._awaiting_ok      = deque()
+        self._resends          = 0
+        # Time the stop handlers take on the loop: writing M112 out, not the firmware reacting to it.
+        self._stop_call_time   = {'emergency_stop': Histogram(), 'stop_print': Histogram()}
 
     def errorcb(self, error):
-        log("* Error: " + error.strip())
+        log.error('printer', "%s: %s", self.machine_id, error.strip())
+        log.dump_traffic(self.machine_id, 'printer error')
 
     def sendcb(self, command):
-        log("> " + command.strip())
+        self._lines_sent.add()
+        self._awaiting_ok.append(time())
+        log.traffic(self.machine_id, '>', command)
+
+    def stats(self):
+        return({'lines_sent': self._lines_sent.report(), 'ok_latency': self._ok_latency.report(), 'resends': self._resends,
+                'stop_call_time': dict((kind, latency.report()) for kind, latency in self._stop_call_time.iteritems()),
+                'lock_wait': {'printer': self.printer_lock.wait.report(), 'state': self._mutex.wait.report()}})
 
     def start(self):
-        threading.Thread(target=self._update).start()
-        threading.Thread(target=self._run).start()
+        # Reported in machine_info and every info message until another job
+        # (or this one, resumed) starts printing.
+        self._interrupted = self._checkpoint.load()
+        self._autoreport_interval = None
+        threading.Thread(target=self._connect).start()
+        self._server.call_later(1, self._run)
+
+    def stop(self):
+        if not self.running: return
+        self.running = False
+        threading.Thread(target=self._disconnect).start()
 
     def _run(self):
-        while self._server.running:
-            sleep(1)
-
-            self._mutex.acquire()
-            temp_msg         = {'action': 'temperature', 'data': self._temperatures}
-            info_msg         = {'action': 'info', 'data': {'current_line': self._current_line, 'printing': self._printing, 'paused': self._paused, 'machine_info': self._machine_info, 'current_segment': self._current_segment}}
-            temp_subscribers = self._temp_subscribers
-            info_subscribers = self._info_subscribers
-            raw_subscribers  = self._raw_subscribers
-            ok               = self._ok
-            raw_output       = list(self._raw_output)
-            other_messages   = list(self._other_messages)
-            self._raw_output.clear()
-            self._other_messages.clear()
-
-            log("- status ok? " + str(ok) + " __printer p:" + str(self.__printer.printing) + " ol:" + str(self.__printer.online) + " c:" + str(self.__printer.clear))
+        if not (self.running and self._server.running): return
 
-            self._mutex.release()
-
-            if not self._ok:
-              print "burijji: disconnected"
-              other_messages.append({'action': 'disconnected'})
+        self._mutex.acquire()
+        info_data        = {'current_line': self._current_line, 'printing': self._printing, 'paused': self._paused, 'machine_info': self._machine_info,
+                            'current_segment': self._current_segment, 'progress': self._progress, 'print_interrupted': self._interrupted}
+        temp_msg         = {'action': 'temperature', 'machine': self.machine_id, 'data': self._temperatures}
+        info_msg         = {'action': 'info', 'machine': self.machine_id, 'data': info_data}
+        temp_changes     = self._temp_state.update(self._temperatures)
+        info_changes     = self._info_state.update(info_data)
+        temp_delta_msg   = {'action': 'temperature', 'machine': self.machine_id, 'data': temp_changes, 'version': self._temp_state.version, 'delta': True}
+        info_delta_msg   = {'action': 'info', 'machine': self.machine_id, 'data': info_changes, 'version': self._info_state.version, 'delta': True}
+        temp_subscribers = list(self._temp_subscribers)
+        info_subscribers = list(self._info_subscribers)
+        raw_subscribers  = list(self._raw_subscribers)
+        temp_delta_subscribers = list(self._temp_delta_subscribers)
+        info_delta_subscribers = list(self._info_delta_subscribers)
+        ok               = self._ok
+        temperatures     = dict(self._temperatures)
+        raw_output       = list(self._raw_output)
+        other_messages   = list(self._other_messages)
+        self._raw_output.clear()
+        self._other_messages.clear()
+
+        log.debug('status', "%s: ok? %s printing: %s online: %s clear: %s", self.machine_id, ok, self.__printer.printing, self.__printer.online, self.__printer.clear)
 
-            for fileno in temp_subscribers: self._server.add_to_queue(fileno, temp_msg)
-            for fileno in info_subscribers:
-                self._server.add_to_queue(fileno, info_msg)
-                for message in other_messages:
-                    self._server.add_to_queue(fileno, message)
-            for fileno in raw_subscribers:
-                for line in raw_output:
-                    self._server.add_to_queue(fileno, {'action': 'raw', 'data': line})
+        self._mutex.release()
 
-            if not self._ok:
-              self._server.stop()
+        if not self._ok:
+          log.warning('printer', "%s: disconnected", self.machine_id)
+          other_messages.append({'action': 'disconnected', 'machine': self.machine_id})
+
+        self._history.record(time(), temperatures)
+        self._server.broadcast(temp_subscribers, temp_msg, 'temperature')
+        self._server.broadcast(info_subscribers, info_msg, 'info')
+        if temp_changes: self._server.broadcast(temp_delta_subscribers, temp_delta_msg, 'temperature_delta')
+        if info_changes: self._server.broadcast(info_delta_subscribers, info_delta_msg, 'info_delta')
+        for message in other_messages: self._server.broadcast(info_subscribers + info_delta_subscribers, message)
+        if raw_subscribers:
+            for line in raw_output: self._server.broadcast(raw_subscribers, {'action': 'raw', 'machine': self.machine_id, 'data': line}, 'raw')
+
+        if not self._ok:
+          self._server.remove_machine(self.port)
+        else:
+          self._server.call_later(1, self._run)
 
-    def _update(self):
+    # Opening the port waits out the board's reset and closing it joins
+    # printcore's threads: both run on threads of their own, never on the
+    # server loop every other machine shares. connection_lock keeps a stop
+    # from closing a port that is still being opened.
+    def _connect(self):
         printer        = self.__printer
         printer.recvcb = self._parse_line
         printer.endcb  = self._advance_segment
-        printer.connect(self._server.port, self._server.baud)
-        sleep(1)
+        with self.connection_lock:
+            printer.connect(self.port, self.baud)
+        self._server.call_soon(self._connected)
+
+    def _connected(self):
+        if not self.running: return
+        log.info('printer', "%s: connected, online: %s", self.machine_id, self.__printer.online)
+        # Opening the port resets the board, which forgets its M155 interval.
+        self._autoreport_interval = None
+        self._server.call_later(1, self._identify)
+
+    def _disconnect(self):
+        with self.connection_lock:
+            with self.printer_lock:
+                self.__printer.disconnect()
 
+    def _identify(self):
         with self.printer_lock:
-            printer.send_now('M115')
+            self.__printer.send_now('M115')
+        self._server.call_later(1, self._update)
+        self._server.call_later(1, self._poll)
 
+    def _poll(self):
+        if not (self.running and self._server.running): return
+        interval = self._poll_interval()
+        with self.printer_lock:
+            if not self._autoreport:
+                self.__printer.send_now('M105')
+            elif interval != self._autoreport_interval:
+                # The firmware pushes temperatures itself (M155), only tell it how often.
+                self.__printer.send_now('M155 S' + str(interval))
+                self._autoreport_interval = interval
+                self._reported_at         = time()
+            elif time() - self._reported_at > self._missed_reports * interval:
+                # Reports stopped (the board was reset behind our back): ask
+                # once and set the interval again on the next poll.
+                self.__printer.send_now('M105')
+                self._autoreport_interval = None
+        self._server.call_later(1 if self._autoreport else interval, self._poll)
+
+    def _poll_interval(self):
+        self._mutex.acquire()
+        temperatures = dict(self._temperatures)
+        targets      = dict(self._targets)
+        previous     = self._polled_temperatures
+        printing     = self._printing
+        self._polled_temperatures = temperatures
+        self._mutex.release()
 
-        while self._server.running:
-            sleep(1)
-            with self.printer_lock:
-                printer.send_now('M105')
-            self._mutex.acquire()
-            self._current_line = printer.queueindex
-            self._printing     = printer.printing
-            self._paused       = printer.paused
-            self._ok           = (printer.writefailures < 10)
-            self._mutex.release()
+        heating = any(targets.get(heater, 0) > 0 and abs(targets[heater] - temperature) > 2 for heater, temperature in temperatures.iteritems())
+        moving  = any(abs(temperature - previous.get(heater, temperature)) > 1 for heater, temperature in temperatures.iteritems())
+        if heating or moving: return(self._poll_intervals['heating'])
+        if printing:          return(self._poll_intervals['printing'])
+        return(self._poll_intervals['idle'])
+
+    def _acknowledged_line(self):
+        # printcore sends a line once the one before it was acknowledged, only
+        # the last one sent can still be waiting (clear is False meanwhile).
+        # queueindex is read first, it moves on right after clear drops.
+        printer = self.__printer
+        index   = printer.queueindex
+        if not printer.clear: index = max(0, index - 1)
+        return(self._job.line_at(index) if self._job else index)
+
+    def _save_checkpoint(self):
+        # The line to resume from is the first one the firmware hasn't acknowledged.
+        progress = self._progress or {}
+        line     = self._acknowledged_line()
+        self._mutex.acquire()
+        state    = {'file': self._gcode_file, 'line': line, 'segment': self._current_segment, 'z': progress.get('z'),
+                    'e': progress.get('filament_used'), 'temperatures': dict(self._temperatures), 'targets': dict(self._targets)}
+        self._mutex.release()
+        self._checkpoint.save(state, time())
 
-        with self.printer_lock:
-            self.__printer.disconnect()
+    def _update(self):
+        if not (self.running and self._server.running): return
+        printer = self.__printer
+        self._mutex.acquire()
+        self._current_line = self._job.line_at(printer.queueindex) if self._job else printer.queueindex
+        self._progress     = self._index.progress(self._current_line) if self._index else None
+        self._printing     = printer.printing
+        self._paused       = printer.paused
+        self._ok           = (printer.writefailures < 10)
+        self._mutex.release()
+        if self._index and self._current_segment == 'printing': self._save_checkpoint()
+        self._server.call_later(1, self._update)
 
     def machine_info(self, fileno, data):
-        self._server.add_to_queue(fileno, {'action': 'machine_info', 'data': self._machine_info})
+        self._server.add_to_queue(fileno, {'action': 'machine_info', 'machine': self.machine_id, 'data': dict(self._machine_info, print_interrupted=self._interrupted)})
+
+    def temperature_history(self, fileno, data):
+        if type(data) is not dict or 'start' not in data:
+            return(self.bad_data_sent(fileno))
+        try:
+            first, step, count, heaters, values = self._history.query(data['start'], data.get('end', time()), data.get('heaters'))
+        except (TypeError, ValueError):
+            return(self.bad_data_sent(fileno))
+        self._server.add_to_queue(fileno, {'action': 'temperature_history', 'machine': self.machine_id,
+                                           'data': {'start': first, 'step': step, 'count': count, 'heaters': heaters, 'encoding': 'float32le', 'values': values}})
 
     def send_commands(self, fileno, data):
-        if type(data) is list:
+        if type(data) is list and all(isinstance(command, basestring) for command in data):
             self._send_commands(data)
         else:
             self.bad_data_sent(fileno)
 
     def print_file(self, fileno, data):
+        if not isinstance(data, basestring): return(self.bad_data_sent(fileno))
+        if not self._readable(fileno, data): return
         self._mutex.acquire()
-        if fileno not in self._info_subscribers: self._info_subscribers.append(fileno)
+        if fileno not in self._info_subscribers and fileno not in self._info_delta_subscribers: self._info_subscribers.append(fileno)
         self._mutex.release()
 
         self.add_other_message({'action': 'print_started', 'data': ''})
@@ -129,9 +282,29 @@ class repWrapper:
         self._advance_segment()
 
     def stop_print(self, fileno, data):
+        requested = time()
         self._stop_print()
+        self._stop_call_time['stop_print'].add(time() - requested)
         self.add_other_message({'action': 'print_stopped', 'data': ''})
 
+    def emergency_stop(self, fileno, data):
+        requested = time()
+        self._write_now('M112')
+        self._stop_call_time['emergency_stop'].add(time() - requested)
+        # The firmware has halted, stopping the queue can take its time. The
+        # checkpoint is kept so the job can be resumed once the printer is reset.
+        self._server.call_soon(self._halt)
+
+    def _halt(self):
+        with self.printer_lock:
+            self.__printer.endcb = None
+            self.__printer.pause()
+        # The firmware needs a reset after M112, which drops M155.
+        self._autoreport_interval = None
+        self._current_segment = 'none'
+        self._index           = None
+        self.add_other_message({'action': 'emergency_stopped', 'data': ''})
+
     def pause_print(self, fileno, data):
         if self._printing:
             self._pause_print()
@@ -140,6 +313,8 @@ class repWrapper:
 
     def print_complete(self):
         self._current_segment  = 'none'
+        self._index            = None
+        self._checkpoint.clear()
         self.add_other_message({'action': 'print_complete', 'data': ''})
 
     def resume_print(self, fileno, data):
@@ -148,7 +323,29 @@ class repWrapper:
             if 'resume' in self._routines: self._send_commands(self._routines['resume_print'])
             self._resume_print()
 
+    def resume_print_from(self, fileno, data):
+        # Without a file and line, pick up where the last checkpoint left off.
+        checkpoint = self._checkpoint.load() or {}
+        if data is None or data == '': data = {}
+        if type(data) is not dict: return(self.bad_data_sent(fileno))
+        path = data.get('file', checkpoint.get('file'))
+        line = data.get('line', checkpoint.get('line'))
+        if not isinstance(path, basestring) or type(line) not in (int, long) or line < 0: return(self.bad_data_sent(fileno))
+        if self._current_segment != 'none':
+            return(self._server.add_to_queue(fileno, {'action': 'resume_error', 'machine': self.machine_id, 'data': 'Machine is already printing.'}))
+        if not self._readable(fileno, path): return
+
+        self._mutex.acquire()
+        if fileno not in self._info_subscribers and fileno not in self._info_delta_subscribers: self._info_subscribers.append(fileno)
+        self._mutex.release()
+
+        self.add_other_message({'action': 'print_resumed_from', 'data': {'file': path, 'line': line}})
+        self._gcode_file      = path
+        self._current_segment = 'printing'
+        threading.Thread(target=self._load_file, args=[path, line, checkpoint.get('targets')]).start()
+
     def run_routine(self, fileno, data):
+        if not isinstance(data, basestring): return(self.bad_data_sent(fileno))
         if data in self._routines:
             self._send_commands(self._routines[data])
         else: self._server.add_to_queue(fileno, {'action': 'routine_error', 'data': 'routine not defined'})
@@ -156,96 +353,115 @@ class repWrapper:
     def update_routines(self, fileno, data):
         if type(data) is dict:
             for key,val in data.iteritems():
-                if type(val) is not list: return(self.bad_data_sent(fileno))
+                if type(val) is not list or not all(isinstance(command, basestring) for command in val): return(self.bad_data_sent(fileno))
             self._routines.update(data)
         else:
             self.bad_data_sent(fileno)
 
     def add_other_message(self, message):
+        message['machine'] = self.machine_id
         self._mutex.acquire()
         self._other_messages.append(message)
         self._mutex.release()
 
     def subscribe(self, fileno, data):
-        subscription = data['type']
+        if type(data) is not dict: return(self.bad_data_sent(fileno))
+        subscription = data.get('type')
         if subscription not in ['temperature','info','raw','all']:
             return(self._server.add_to_queue(fileno, {'action': 'data_error', 'data': 'Invalid subscription type.'}))
 
+        # Delta subscribers get a versioned snapshot now and changed fields afterwards.
+        delta = data.get('delta', False)
+        if delta:
+            temp_subscribers = self._temp_delta_subscribers
+            info_subscribers = self._info_delta_subscribers
+        else:
+            temp_subscribers = self._temp_subscribers
+            info_subscribers = self._info_subscribers
+
+        # Subscribing again (as delta clients do after a version gap) only sends a fresh snapshot.
         self._mutex.acquire()
-        if subscription == 'temperature':
-            self._temp_subscribers.append(fileno)
-        elif subscription == 'info':
-            self._info_subscribers.append(fileno)
-        elif subscription == 'raw':
-            self._raw_subscribers.append(fileno)
-        elif subscription == 'all':
-            self._temp_subscribers.append(fileno)
-            self._info_subscribers.append(fileno)
-            self._raw_subscribers.append(fileno)
+        if subscription in ['temperature', 'all']:
+            self._add(temp_subscribers, fileno)
+        if subscription in ['info', 'all']:
+            self._add(info_subscribers, fileno)
+        if subscription in ['raw', 'all']:
+            self._add(self._raw_subscribers, fileno)
+        snapshots = []
+        if delta and subscription in ['temperature', 'all']:
+            snapshots.append({'action': 'temperature', 'machine': self.machine_id, 'data': self._temp_state.snapshot(), 'version': self._temp_state.version})
+        if delta and subscription in ['info', 'all']:
+            snapshots.append({'action': 'info', 'machine': self.machine_id, 'data': self._info_state.snapshot(), 'version': self._info_state.version})
         self._mutex.release()
 
+        for snapshot in snapshots: self._server.add_to_queue(fileno, snapshot)
+
     def unsubscribe(self, fileno, data):
-        subscription = data['type']
+        if type(data) is not dict: return(self.bad_data_sent(fileno))
+        subscription = data.get('type')
         if subscription not in ['temperature','info','raw','all']:
             return(self._server.add_to_queue(fileno, {'action': 'data_error', 'data': 'Invalid subscription type.'}))
 
         self._mutex.acquire()
-        if subscription == 'temperature':
-            try:
-                self._temp_subscribers.remove(fileno)
-            except:
-                pass
-        elif subscription == 'info':
-            try:
-                self._info_subscribers.remove(fileno)
-            except:
-                pass
-        elif subscription == 'raw':
-            try:
-                self._raw_subscribers.remove(fileno)
-            except:
-                pass
-        else:
-            try:
-                self._temp_subscribers.remove(fileno)
-            except:
-                pass
-            try:
-                self._info_subscribers.remove(fileno)
-            except:
-                pass
-            try:
-                self._raw_subscribers.remove(fileno)
-            except:
-                pass
+        if subscription in ['temperature', 'all']:
+            self._discard(self._temp_subscribers, fileno)
+            self._discard(self._temp_delta_subscribers, fileno)
+        if subscription in ['info', 'all']:
+            self._discard(self._info_subscribers, fileno)
+            self._discard(self._info_delta_subscribers, fileno)
+        if subscription in ['raw', 'all']:
+            self._discard(self._raw_subscribers, fileno)
         self._mutex.release()
 
+    def _add(self, subscribers, fileno):
+        if fileno not in subscribers: subscribers.append(fileno)
+
+    def _discard(self, subscribers, fileno):
+        while fileno in subscribers: subscribers.remove(fileno)
+
+    def _readable(self, fileno, path):
+        if os.path.isfile(path) and os.access(path, os.R_OK): return(True)
+        self._server.add_to_queue(fileno, {'action': 'data_error', 'machine': self.machine_id, 'data': "Can't read '" + path + "'."})
+        return(False)
+
     def bad_data_sent(self, fileno):
         self._server.add_to_queue(fileno, {'action': 'data_error', 'data': 'Malformed data.'})
 
+    def _write_now(self, command):
+        # The priority lane: straight onto the serial port, past printcore's
+        # queues, its wait for ok and printer_lock. Only write_lock is taken,
+        # so this lands between two lines at worst.
+        port = getattr(self.__printer, 'printer', None)
+        try:
+            if port is not None:
+                with self.__printer.write_lock: return(port.write(command + "\n"))
+        except (IOError, OSError, ValueError) as e:
+            log.error('printer', "%s: priority write of %s failed: %s", self.machine_id, command, e)
+        self.__printer.send_now(command)
+
     def _send_commands(self, commands):
         with self.printer_lock:
             for command in commands:
                 self.__printer.send_now(command)
 
     def _advance_segment(self):
-        log("* Advance Segment c: " + self._current_segment)
+        log.info('print', "%s: advancing from segment %s", self.machine_id, self._current_segment)
         if self._current_segment == 'none':
             self._current_segment = 'starting'
             if 'start_print' in self._routines:
-                threading.Thread(target=self._delayed_start, args=[self._routines['start_print']]).start()
+                self._delayed_start(self._routines['start_print'])
             else:
                 self._advance_segment()
 
         elif self._current_segment == 'starting':
             self._current_segment = 'printing'
-            threading.Thread(target=self._delayed_start, args=[[i.strip() for i in open(self._gcode_file)]]).start()
+            threading.Thread(target=self._load_file, args=[self._gcode_file]).start()
             self.add_other_message({'action': 'segment_completed', 'data': 'start_segment'})
 
         elif self._current_segment == 'printing':
             self._current_segment = 'ending'
             if 'end_print' in self._routines:
-                threading.Thread(target=self._delayed_start, args=[self._routines['end_print']]).start()
+                self._delayed_start(self._routines['end_print'])
             else:
                 self._advance_segment()
             self.add_other_message({'action': 'segment_completed', 'data': 'print_segment'})
@@ -255,35 +471,52 @@ class repWrapper:
             self._current_segment = 'none'
             self.add_other_message({'action': 'segment_completed', 'data': 'end_segment'})
 
+    def _load_file(self, path, start=0, targets=None):
+        # Indexing a whole job is too slow for the server loop.
+        try:
+            source = GCodeSource(path, self._server.gcode_cache.index_for(path))
+            # printcore's send_now wouldn't wait for oks, the preamble goes first in the job instead.
+            if start: source = ResumedSource(source, resume_commands(source.state_at(start), targets, self._routines.get('resume_from')), start)
+        except Exception as e:
+            self._load_failed(path, e)
+            return
+        self._interrupted = None
+        self._delayed_start(source)
+
+    def _load_failed(self, path, error):
+        # Nothing would ever move the machine on from 'printing' otherwise.
+        log.error('print', "%s: could not load %s: %s", self.machine_id, path, error)
+        self._current_segment = 'none'
+        self._index           = None
+        self.add_other_message({'action': 'data_error', 'data': "Could not load '" + path + "': " + str(error)})
+
     def _delayed_start(self, data):
-        sleep(0.1)
-        gcode = gcoder.GCode(data)
-        self.__printer.endcb  = self._advance_segment
+        gcode = data if isinstance(data, GCodeSource) else gcoder.GCode(data)
+        self._server.call_later(0.1, self._start_gcode, gcode, data)
 
-        log("* Delayed start c: " + str(self.__printer.clear))
-        
-        print_started = False
-        while True:
-            with self.printer_lock:
-                log("* startprint attempt c: " + str(self.__printer.clear))
-                print_started = self.__printer.startprint(gcode)
+    def _start_gcode(self, gcode, data):
+        if not self.running: return
+        self.__printer.endcb  = self._advance_segment
 
-            if print_started:
+        with self.printer_lock:
+            log.debug('print', "%s: startprint attempt, clear: %s", self.machine_id, self.__printer.clear)
+            print_started = self.__printer.startprint(gcode)
+
+        if not print_started:
+            return(self._server.call_later(0.1, self._start_gcode, gcode, data))
+        # Only the job itself has an index, routines report no progress.
+        self._index = data.index if isinstance(data, GCodeSource) else None
+        self._job   = data if isinstance(data, GCodeSource) else None
+
+        log.info('print', "%s: starting print, %d lines", self.machine_id, len(data))
+        if log.enabled('print', DEBUG):
+            lines = 0
+            for line in data:
+              log.debug('print', "%s: ==> %s", self.machine_id, line.strip())
+              lines += 1
+              if lines > 30:
                 break
 
-            sleep(0.1)
-
-
-        log("* Starting print. Total lines: " + str(len(data)))
-        log("* Clear: " + str(self.__printer.clear))
-        log("* GCode Sample:")
-        lines = 0
-        for line in data:
-          log("* ==> " + line.strip())
-          lines += 1
-          if lines > 30:
-            break
-
     def _end_print(self):
         if 'cancel_print' in self._routines: self._send_commands(self._routines['cancel_print'])
         self.print_complete()
@@ -312,28 +545,25 @@ class repWrapper:
             self.__printer.resume()
 
     def _parse_line(self, line):
-        self._mutex.acquire()
-        log("< " + line.strip())
-        self._raw_output.append(line)
-        self._mutex.release()
+        kind, temperatures, targets, info = self._parser.parse(line)
+        if kind == 'ok':
+            try:
+                self._ok_latency.add(time() - self._awaiting_ok.popleft())
+            except IndexError:
+                pass
+        elif kind == 'resend':
+            # The firmware rewinds to the requested line, timings can't be paired any more.
+            self._resends += 1
+            self._awaiting_ok.clear()
+        elif kind == 'capability':
+            if info.get('AUTOREPORT_TEMP'): self._autoreport = True
+
+        log.traffic(self.machine_id, '<', line)
 
-        temp_matches = self._temp_exp.findall(line)
-        temps        = dict((m[0].lower(), float(m[1])) for m in temp_matches)
         self._mutex.acquire()
-        self._temperatures.update(temps)
+        self._raw_output.append(line)
+        if temperatures:       self._temperatures.update(temperatures)
+        if targets:            self._targets.update(targets)
+        if temperatures:       self._reported_at = time()
+        if kind == 'firmware': self._machine_info.update(info)
         self._mutex.release()
-
-        if 'FIRMWARE' in line:
-            firmware_name  = line.split('FIRMWARE_NAME:')[1].split(';')[0]
-            machine_type   = line.split('MACHINE_TYPE:')[1].split()[0]
-            extruder_count = int(line.split('EXTRUDER_COUNT:')[1].split()[0])
-
-            uuid_match = self._uuid_exp.findall(line.lower())
-            if len(uuid_match): uuid = uuid_match[0]
-            else:               uuid = None
-
-            info_dict = {'firmware_name': firmware_name, 'machine_type': machine_type, 'extruder_count': extruder_count, 'uuid': uuid}
-            
-            self._mutex.acquire()
-            self._machine_info.update(info_dict)
-            self._mutex.release()
@@ -0,0 +1,57 @@
+import re
+
+class ResponseParser:
+    """Classifies firmware response lines for the wrappers' on_receive.
+
+    Each line costs a few startswith()/in checks, regexes only run on the
+    lines that carry temperatures or firmware info. parse() returns
+    (kind, temperatures, targets, info) with kind one of 'ok', 'resend',
+    'error', 'firmware', 'capability' or 'other'; the other three are dicts
+    or None. Temperatures can ride along with an 'ok' or come on their own.
+    """
+    _temp_exp    = re.compile("(?<![A-Za-z_])([TB]\d*):([-+]?\d*\.?\d*)")
+    _target_exp  = re.compile("(?<![A-Za-z_])([TB]\d*):[-+]?\d*\.?\d*\s*/\s*([-+]?\d+\.?\d*)")
+    _uuid_exp    = re.compile("UUID:([0-F]{8}-[0-F]{4}-4[0-F]{3}-[89AB][0-F]{3}-[0-F]{12})", re.I)
+    _plain_ok    = ('ok', None, None, None)
+
+    def parse(self, line):
+        if line.startswith('ok'):
+            temperatures, targets = self._temperatures(line)
+            if temperatures is None: return(self._plain_ok)
+            return(('ok', temperatures, targets, None))
+        if line.startswith('rs') or line.startswith('Resend'):
+            return(('resend', None, None, None))
+        if line.startswith('Error') or line.startswith('!!'):
+            return(('error', None, None, None))
+        if 'FIRMWARE' in line:
+            return(('firmware', None, None, self._firmware(line)))
+        if line.startswith('Cap:'):
+            name, _, enabled = line[4:].strip().partition(':')
+            return(('capability', None, None, {name: enabled == '1'}))
+        return(('other',) + self._temperatures(line) + (None,))
+
+    def _temperatures(self, line):
+        if 'T:' not in line and 'B:' not in line: return((None, None))
+        temperatures = dict((m[0].lower(), float(m[1])) for m in self._temp_exp.findall(line) if m[1])
+        targets      = dict((m[0].lower(), float(m[1])) for m in self._target_exp.findall(line)) if '/' in line else None
+        return((temperatures or None, targets or None))
+
+    def _firmware(self, line):
+        firmware_name  = line.split('FIRMWARE_NAME:')[1].split(';')[0]
+        machine_type   = line.split('MACHINE_TYPE:')[1].split()[0]
+        extruder_count = int(line.split('EXTRUDER_COUNT:')[1].split()[0])
+
+        uuid_match = self._uuid_exp.findall(line.lower())
+        if len(uuid_match): uuid = uuid_match[0]
+        else:               uuid = None
+
+        return({'firmware_name': firmware_name, 'machine_type': machine_type, 'extruder_count': extruder_count, 'uuid': uuid})
+
+class GPXResponseParser(ResponseParser):
+    """gpx's verbose log reports "Extruder T0 temperature: 210c" and no setpoints."""
+    _temp_exp = re.compile("([TB]\d*) temperature: ([-+]?\d*\.?\d*)c")
+
+    def _temperatures(self, line):
+        if ' temperature: ' not in line: return((None, None))
+        temperatures = dict((m[0].lower(), float(m[1])) for m in self._temp_exp.findall(line) if m[1])
+        return((temperatures or None, None))
@@ -1,76 +1,308 @@
-import os, sys, socket, select, threading, msgpack, serial
+import os, sys, errno, socket, select, threading, fcntl, heapq, itertools, traceback, multiprocessing, msgpack, serial
 from collections import deque
 from time        import time
-from time        import sleep
 from repWrapper  import repWrapper
 from mbWrapper  import mbWrapper
+from metrics     import Histogram, RateCounter
+from gcodecache  import GCodeCache
+from x3gjob      import X3GCache
+
+class Frame(str):
+    """A message packed once by broadcast() and shared by every queue it is put on."""
+    __slots__ = ()
 
 class BurijjiServer():
     __epoll_ro = (select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP | select.EPOLLERR)
     __epoll_rw = __epoll_ro | select.EPOLLOUT
+    __poll_timeout = 1.0
+    __write_chunk  = 65536
+    __write_batch  = 1024
+
+    # Once a connection has high_water_mark messages queued, messages of the
+    # kinds below are handled by their policy instead of being queued:
+    # 'coalesce' keeps only the newest, 'drop' discards, 'sample' keeps one in
+    # sample_rate and 'disconnect' closes the connection. Replies and other
+    # unkinded messages are always queued. Dropped deltas show up as a version
+    # gap, on which delta subscribers resubscribe for a fresh snapshot.
+    high_water_mark        = 1000
+    sample_rate            = 10
+    slow_consumer_policies = {'temperature': 'coalesce', 'info': 'coalesce', 'raw': 'drop',
+                              'temperature_delta': 'drop', 'info_delta': 'drop'}
+    _policies              = ['coalesce', 'drop', 'sample', 'disconnect']
+
+    _machine_types = {'x3g': mbWrapper}
 
-    def __init__(self, port, sock, baud, protocol):
+    def __init__(self, port, sock, baud, protocol, high_water_mark=None, slow_consumer_policies=None, cache_dir=None, checkpoint_dir=None, x3g_cache_dir=None,
+                 index_workers=None):
+        # Forked first, before this process has any sockets, pipes or threads
+        # the workers would keep open. index_workers=0 indexes every file in
+        # the calling thread instead.
+        self.parse_pool        = multiprocessing.Pool(index_workers) if index_workers != 0 else None
         self.port              = port
         self.baud              = baud
         self.protocol          = protocol
-        self.port_name         = self.port.split('/')[-1]
+        self.port_name         = self.port.split('/')[-1] if self.port else None
 
         self.running           = True
+        self.gcode_cache       = GCodeCache(cache_dir or os.path.expanduser('~/.burijji/gcode_cache'), self.parse_pool)
+        self.checkpoint_dir    = checkpoint_dir or os.path.expanduser('~/.burijji/checkpoints')
+        self.x3g_cache         = X3GCache(x3g_cache_dir or os.path.expanduser('~/.burijji/x3g_cache'), self.gcode_cache)
+        self.__started         = False
+        self.__machines        = {}
+        self.__machine_ids     = {}
         self.__sock            = sock
         self.__epoll           = select.epoll()
         self.__socketserver    = None
         self.__outbound_queues = {}
+        self.__outbound_buffers = {}
+        self.__packer          = msgpack.Packer()
         self.__connections     = {}
         self.__unpackers       = {}
+        self.__dropped         = {}
+        self.__coalesced       = {}
+        self.__sampled         = {}
+        self.__doomed          = set()
+        self.__bytes_in        = {}
+        self.__bytes_out       = {}
+        self.__loop_latency    = Histogram()
+        self.__timer_lateness  = Histogram()
+        self.__action_rates    = {}
+        self.__started_at      = time()
+        self.__high_water      = high_water_mark or self.high_water_mark
+        self.__policies        = dict(self.slow_consumer_policies)
+        self.__policies.update(slow_consumer_policies or {})
+        for kind, policy in self.__policies.iteritems():
+            if policy not in self._policies: raise ValueError("Unknown slow consumer policy '" + str(policy) + "' for '" + str(kind) + "'")
         self.__mutex           = threading.Lock()
+        self.__pending_writes  = set()
+        self.__timers          = []
+        self.__timer_seq       = itertools.count()
+        self.__wake_pending    = False
+        self.__loop_thread     = None
+        self.__request_id      = None
+        self.__request_fileno  = None
+        self.__replied         = False
+        self.__wake_r, self.__wake_w = os.pipe()
+        for fd in (self.__wake_r, self.__wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
         self._operations       = ['machine_info', 'send_commands', 'print_file', 'pause_print', 'resume_print']
-        self._operations      += ['run_routine', 'update_routines', 'subscribe', 'unsubscribe', 'stop_print']
+        self._operations      += ['run_routine', 'update_routines', 'subscribe', 'unsubscribe', 'stop_print', 'temperature_history']
+        self._operations      += ['resume_print_from', 'emergency_stop']
+        self._server_operations = ['machines', 'stats', 'prepare_file']
 
         print "BurijjiServer Initialized"
-        print "Creating machine with protocol '" + str(self.protocol["protocol"]) + "'"
-        if self.protocol["protocol"] == "x3g":
-          self.__machine = mbWrapper(self, protocol)
-        else:
-          self.__machine = repWrapper(self)
+        if self.port: self.add_machine(self.port, self.baud, self.protocol)
+
+    def add_machine(self, port, baud, protocol):
+        """Hosts the printer on `port`; messages address it by its port or port name."""
+        if port in self.__machines: raise ValueError("Machine already hosted on '" + port + "'")
+        print "Creating machine on '" + port + "' with protocol '" + str(protocol["protocol"]) + "'"
+        machine = self._machine_types.get(protocol["protocol"], repWrapper)(self, port, baud, protocol)
+        with self.__mutex:
+            self.__machines[port]                = machine
+            self.__machine_ids[machine.machine_id] = port
+            started = self.__started
+        if started: machine.start()
+        return(machine)
+
+    def remove_machine(self, port):
+        with self.__mutex:
+            machine = self.__machines.pop(port, None)
+            if machine is None: return
+            del self.__machine_ids[machine.machine_id]
+            remaining = len(self.__machines)
+        machine.stop()
+        print "Removed machine '" + machine.machine_id + "'"
+        # A single printer daemon exits with its printer, as it always has.
+        if not remaining: self.stop()
+
+    def machines(self, fileno, data):
+        with self.__mutex:
+            machines = [{'machine': machine.machine_id, 'port': port, 'protocol': machine.protocol} for port, machine in self.__machines.iteritems()]
+        self.add_to_queue(fileno, {'action': 'machines', 'data': machines})
+
+    def stats(self, fileno, data):
+        with self.__mutex:
+            machines    = self.__machines.values()
+            connections = dict((f, {'queued': len(queue), 'buffered': len(self.__outbound_buffers.get(f, '')), 'dropped': dict(self.__dropped[f]),
+                                    'bytes_in': self.__bytes_in.get(f, 0), 'bytes_out': self.__bytes_out.get(f, 0)})
+                               for f, queue in self.__outbound_queues.iteritems())
+            timers      = len(self.__timers)
+        server = {'uptime': time() - self.__started_at, 'timers': timers, 'loop_iteration': self.__loop_latency.report(),
+                  'timer_lateness': self.__timer_lateness.report(),
+                  'actions': dict((action, rate.report()) for action, rate in self.__action_rates.items())}
+        self.add_to_queue(fileno, {'action': 'stats', 'data': {'server': server, 'connections': connections,
+                                                               'machines': dict((m.machine_id, m.stats()) for m in machines)}})
+
+    def prepare_file(self, fileno, data):
+        threading.Thread(target=self.__prepare_file, args=[fileno, data, self.defer_reply()]).start()
+
+    def __prepare_file(self, fileno, path, request_id):
+        try:
+            index = self.gcode_cache.index_for(path)
+        except (IOError, OSError, TypeError) as e:
+            return(self.add_to_queue(fileno, {'action': 'file_error', 'id': request_id, 'data': {'file': path, 'error': str(e)}}))
+        estimator = index.estimator
+        self.add_to_queue(fileno, {'action': 'file_prepared', 'id': request_id,
+                                   'data': {'file': path, 'lines': index.line_count, 'estimated_time': int(estimator.elapsed),
+                                            'filament': round(estimator.extruded, 1), 'layers': estimator.layer}})
+
+    def defer_reply(self):
+        """For actions that reply from another thread once they return: the
+        correlation id of the request being handled, for the action to put on
+        its reply itself, and no automatic ack in the meantime."""
+        self.__replied = True
+        return(self.__request_id)
+
+    def __machine_for(self, pack):
+        with self.__mutex:
+            machine_id = pack.get('machine')
+            if machine_id is None:
+                if len(self.__machines) == 1: return(self.__machines.values()[0])
+                return(None)
+            port = self.__machine_ids.get(machine_id, machine_id)
+            return(self.__machines.get(port))
 
     def start(self):
-        threading.Thread(target=self.__run).start()
+        self.__loop_thread = threading.Thread(target=self.__run)
+        self.__loop_thread.start()
 
     def stop(self):
         self.running = False
+        self.__wake()
+
+    def call_later(self, delay, callback, *args):
+        """Runs callback(*args) on the server loop after `delay` seconds. Safe to call from any thread."""
+        when = time() + delay
+        with self.__mutex:
+            heapq.heappush(self.__timers, (when, next(self.__timer_seq), callback, args))
+            earliest = self.__timers[0][0] == when
+        if earliest: self.__wake()
+
+    def call_soon(self, callback, *args):
+        self.call_later(0, callback, *args)
+
+    def add_to_queue(self, fileno, data, kind=None):
+        # Replies queued while an action runs on the loop echo its correlation id.
+        if self.__request_id is not None and fileno == self.__request_fileno and kind is None and threading.current_thread() is self.__loop_thread:
+            data.setdefault('id', self.__request_id)
+            self.__replied = True
+        with self.__mutex:
+            self.__enqueue(fileno, data, kind)
+        self.__wake()
+
+    def broadcast(self, filenos, data, kind=None):
+        if not filenos: return
+        frame = Frame(msgpack.packb(data))
+        with self.__mutex:
+            for fileno in filenos: self.__enqueue(fileno, frame, kind)
+        self.__wake()
 
-    def add_to_queue(self, fileno, data):
+    def __enqueue(self, fileno, message, kind):
+        # Must be called with __mutex held.
+        queue = self.__outbound_queues.get(fileno)
+        if queue is None: return
+
+        policy = self.__policies.get(kind)
+        if policy is None or len(queue) < self.__high_water:
+            queue.append(message)
+            # A value coalesced while the client was behind is older than this one.
+            if policy == 'coalesce': self.__coalesced[fileno].pop(kind, None)
+        elif policy == 'disconnect':
+            self.__doomed.add(fileno)
+        elif policy == 'coalesce':
+            coalesced = self.__coalesced[fileno]
+            if kind in coalesced: self.__count_drop(fileno, kind)
+            coalesced[kind] = message
+        elif policy == 'sample':
+            sampled = self.__sampled[fileno]
+            sampled[kind] = sampled.get(kind, 0) + 1
+            if sampled[kind] % self.sample_rate == 0: queue.append(message)
+            else:                                     self.__count_drop(fileno, kind)
+        else:
+            self.__count_drop(fileno, kind)
+        self.__pending_writes.add(fileno)
+
+    def __count_drop(self, fileno, kind):
+        dropped       = self.__dropped[fileno]
+        dropped[kind] = dropped.get(kind, 0) + 1
+
+    def __wake(self):
+        # Replies queued from inside the loop are armed at the end of the
+        # current iteration, only other threads need to interrupt the poll.
+        if threading.current_thread() is self.__loop_thread: return
+        with self.__mutex:
+            if self.__wake_pending: return
+            self.__wake_pending = True
         try:
-            self.__mutex.acquire()
-            self.__outbound_queues[fileno].append(data)
-        except:
+            os.write(self.__wake_w, 'x')
+        except OSError:
             pass
-        finally:
-            self.__mutex.release()
+
+    def __drain_wakeups(self):
+        with self.__mutex:
+            self.__wake_pending = False
+        try:
+            while os.read(self.__wake_r, 4096): pass
+        except OSError:
+            pass
+
+    def __next_timeout(self):
+        with self.__mutex:
+            if not self.__timers: return(self.__poll_timeout)
+            return(min(self.__poll_timeout, max(0, self.__timers[0][0] - time())))
+
+    def __run_timers(self):
+        now = time()
+        due = []
+        with self.__mutex:
+            while self.__timers and self.__timers[0][0] <= now: due.append(heapq.heappop(self.__timers))
+        for when, seq, callback, args in due:
+            self.__timer_lateness.add(now - when)
+            try:
+                callback(*args)
+            except Exception:
+                print "BurijjiServer: error in scheduled callback"
+                traceback.print_exc()
+
+    def __service_pending(self):
+        with self.__mutex:
+            if not self.__pending_writes and not self.__doomed: return
+            pending = self.__pending_writes
+            doomed  = self.__doomed
+            self.__pending_writes = set()
+            self.__doomed         = set()
+        for fileno in doomed:
+            if fileno in self.__connections: self.__teardown_connection(fileno)
+        for fileno in pending:
+            if fileno in self.__connections: self.__epoll.modify(fileno, self.__epoll_rw)
 
     def __run(self):
-        self.__machine.start()
+        with self.__mutex:
+            self.__started = True
+            machines       = self.__machines.values()
+        for machine in machines: machine.start()
         self.__setup_server()
 
         while self.running:
-            sleep(0.01)
-            events = self.__epoll.poll(0)
+            events = self.__epoll.poll(self.__next_timeout())
+            woken  = time()
             for fileno, event in events:
-                if fileno == self.__socketserver.fileno():
-                    if event == select.EPOLLIN:                            self.__setup_connection(self.__socketserver.accept()[0])
-                elif event == select.EPOLLOUT:                             self.__send(fileno)
-                elif event == select.EPOLLIN  or event == select.EPOLLPRI: self.__recv(fileno)
-                elif event == (select.EPOLLIN | select.EPOLLOUT):
-                    self.__recv(fileno)
-                    self.__send(fileno)
-                elif event == (select.EPOLLIN | select.EPOLLHUP):
-                    self.__recv(fileno)
-                    self.__teardown_connection(fileno)
-                elif event == (select.EPOLLIN | select.EPOLLOUT | select.EPOLLHUP):
-                    self.__recv(fileno)
-                    self.__teardown_connection(fileno)
-                elif event == select.EPOLLHUP or event == select.EPOLLERR: self.__teardown_connection(fileno)
+                if fileno == self.__wake_r:
+                    self.__drain_wakeups()
+                elif fileno == self.__socketserver.fileno():
+                    if event & select.EPOLLIN: self.__setup_connection(self.__socketserver.accept()[0])
+                else:
+                    if event & (select.EPOLLIN | select.EPOLLPRI):                       self.__recv(fileno)
+                    if event & select.EPOLLOUT and fileno in self.__connections:         self.__send(fileno)
+                    if event & (select.EPOLLHUP | select.EPOLLERR) and fileno in self.__connections: self.__teardown_connection(fileno)
+            self.__run_timers()
+            self.__service_pending()
+            self.__loop_latency.add(time() - woken)
 
+        with self.__mutex:
+            machines = self.__machines.values()
+        for machine in machines: machine.stop()
         self.__teardown_server()
 
     def __setup_server(self):
@@ -80,15 +312,20 @@ class BurijjiServer():
         socketserver.listen(5)
         socketserver.setblocking(0)
         self.__epoll.register(socketserver.fileno(), self.__epoll_ro)
+        self.__epoll.register(self.__wake_r, select.EPOLLIN)
         self.__socketserver = socketserver
 
     def __teardown_server(self):
         for fileno in self.__connections:
             if fileno != self.__socketserver.fileno(): self.__teardown_connection(fileno)
         self.__epoll.unregister(self.__socketserver.fileno())
+        self.__epoll.unregister(self.__wake_r)
         self.__epoll.close()
         self.__socketserver.close()
+        os.close(self.__wake_r)
+        os.close(self.__wake_w)
         os.remove(self.__sock)
+        if self.parse_pool is not None: self.parse_pool.terminate()
 
     def __setup_connection(self, connection):
         connection.setblocking(0)
@@ -96,50 +333,119 @@ class BurijjiServer():
         self.__epoll.register(fileno, self.__epoll_ro)
         self.__connections[fileno]     = connection
         self.__unpackers[fileno]       = msgpack.Unpacker(use_list=True)
-        self.__outbound_queues[fileno] = deque()
-        self.add_to_queue(fileno,{'action': 'server_info', 'data': {'version': '0.7.0', 'pid': os.getpid()}})
+        self.__outbound_buffers[fileno] = bytearray()
+        self.__bytes_in[fileno]         = 0
+        self.__bytes_out[fileno]        = 0
+        with self.__mutex:
+            self.__outbound_queues[fileno] = deque()
+            self.__dropped[fileno]         = {}
+            self.__coalesced[fileno]       = {}
+            self.__sampled[fileno]         = {}
+        with self.__mutex:
+            machine_ids = self.__machine_ids.keys()
+        self.add_to_queue(fileno,{'action': 'server_info', 'data': {'version': '0.7.0', 'pid': os.getpid(), 'machines': machine_ids}})
 
     def __teardown_connection(self, fileno):
         try:
             self.__epoll.unregister(fileno)
             self.__connections[fileno].close()
             if self.running:
-                self.__machine.unsubscribe(fileno, {'type': 'all'})
+                with self.__mutex:
+                    machines = self.__machines.values()
+                for machine in machines: machine.unsubscribe(fileno, {'type': 'all'})
                 del self.__connections[fileno]
                 del self.__unpackers[fileno]
-                del self.__outbound_queues[fileno]
+                del self.__outbound_buffers[fileno]
+                del self.__bytes_in[fileno]
+                del self.__bytes_out[fileno]
+                with self.__mutex:
+                    del self.__outbound_queues[fileno]
+                    del self.__dropped[fileno]
+                    del self.__coalesced[fileno]
+                    del self.__sampled[fileno]
+                    self.__pending_writes.discard(fileno)
         except: pass
 
     def __send(self, fileno):
-        self.__mutex.acquire()
-        if len(self.__outbound_queues[fileno]) == 0:
-            self.__mutex.release()
-            return(None)
-        message = self.__outbound_queues[fileno].popleft()
-        self.__mutex.release()
+        buffer = self.__outbound_buffers[fileno]
+        with self.__mutex:
+            queue    = self.__outbound_queues[fileno]
+            messages = []
+            if len(buffer) < self.__write_chunk:
+                while queue and len(messages) < self.__write_batch: messages.append(queue.popleft())
+            pending  = len(queue)
+            if not pending:
+                # The backlog has cleared: deliver what was coalesced while
+                # the client was behind and tell it what it missed.
+                coalesced = self.__coalesced[fileno]
+                dropped   = self.__dropped[fileno]
+                if coalesced:
+                    messages.extend(coalesced.values())
+                    coalesced.clear()
+                if dropped:
+                    messages.append({'action': 'messages_dropped', 'data': dict(dropped)})
+                    dropped.clear()
 
         try:
-            message = msgpack.packb(message)
-            return(self.__connections[fileno].send(message))
+            for message in messages:
+                if type(message) is Frame: buffer.extend(message)
+                else:                      buffer.extend(self.__packer.pack(message))
+            if buffer:
+                view = memoryview(buffer)
+                try:
+                    sent = self.__connections[fileno].send(view)
+                finally:
+                    del view
+                del buffer[:sent]
+                self.__bytes_out[fileno] += sent
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): return(self.__teardown_connection(fileno))
         except:
-            self.__teardown_connection(fileno)
+            return(self.__teardown_connection(fileno))
+
+        if not buffer and not pending: self.__epoll.modify(fileno, self.__epoll_ro)
 
     def __recv(self, fileno):
         try:
             data     = self.__connections[fileno].recv(1024)
             unpacker = self.__unpackers[fileno]
         except:
-            self.__teardown_connection(fileno)
-        
+            return(self.__teardown_connection(fileno))
+
         if data:
-            self.__epoll.modify(fileno, self.__epoll_rw)
+            self.__bytes_in[fileno] += len(data)
             unpacker.feed(data)
             for pack in unpacker:
                 if type(pack) is not dict or 'action' not in pack or 'data' not in pack:
-                    self.__machine.bad_data_sent(fileno)
-                elif pack['action'] not in self._operations:
-                    self.add_to_queue(fileno, {'action': 'action_error', 'data': 'Invalid action.'})
-                else:
-                    getattr(self.__machine, pack['action'])(fileno, pack['data'])
+                    reply = {'action': 'data_error', 'data': 'Malformed data.'}
+                    if type(pack) is dict and 'id' in pack: reply['id'] = pack['id']
+                    self.add_to_queue(fileno, reply)
+                    continue
+                if pack['action'] in self._server_operations or pack['action'] in self._operations:
+                    if pack['action'] not in self.__action_rates: self.__action_rates[pack['action']] = RateCounter()
+                    self.__action_rates[pack['action']].add()
+                # Requests may carry an 'id', echoed on their replies or on an
+                # 'ack' for actions that don't reply, so clients can pipeline.
+                self.__request_id     = pack.get('id')
+                self.__request_fileno = fileno
+                self.__replied        = False
+                try:
+                    if pack['action'] in self._server_operations:
+                        getattr(self, pack['action'])(fileno, pack['data'])
+                    elif pack['action'] not in self._operations:
+                        self.add_to_queue(fileno, {'action': 'action_error', 'data': 'Invalid action.'})
+                    else:
+                        machine = self.__machine_for(pack)
+                        if machine is None: self.add_to_queue(fileno, {'action': 'machine_error', 'data': 'Unknown machine.'})
+                        else:               getattr(machine, pack['action'])(fileno, pack['data'])
+                    if self.__request_id is not None and not self.__replied:
+                        self.add_to_queue(fileno, {'action': 'ack', 'data': pack['action']})
+                except Exception:
+                    # Every machine shares this loop, one bad request mustn't take it down.
+                    print "BurijjiServer: error handling '" + str(pack['action']) + "'"
+                    traceback.print_exc()
+                    self.add_to_queue(fileno, {'action': 'data_error', 'data': 'Malformed data.'})
+                finally:
+                    self.__request_id = None
         else:
             self.__teardown_connection(fileno)
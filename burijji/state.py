@@ -0,0 +1,26 @@
+class VersionedState:
+    """Last published value of a flat dict of fields, with a version that
+    increases by one every time at least one field changes.
+
+    Delta subscribers get a snapshot first and then only the fields returned
+    by update(), so a delta whose version isn't the previous one plus one
+    means the client missed a message and should subscribe again.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._values = {}
+
+    def update(self, values):
+        changes = {}
+        for key, value in values.iteritems():
+            if key not in self._values or self._values[key] != value:
+                # Nested dicts are updated in place by the wrappers, keep our own copy.
+                changes[key] = dict(value) if type(value) is dict else value
+        if changes:
+            self._values.update(changes)
+            self.version += 1
+        return(changes)
+
+    def snapshot(self):
+        return(dict(self._values))
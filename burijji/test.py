@@ -0,0 +1,718 @@
+"""Unit tests for the modules that need neither a printer nor a running server.
+
+    cd burijji && python test.py
+"""
+import os
+import math
+import shutil
+import socket
+import struct
+import time
+import tempfile
+import unittest
+import msgpack
+import serial
+import gcodesource
+import mbWrapper
+from gcodesource import GCodeIndex, GCodeSource, ResumedSource, _Estimator
+from history     import TemperatureHistory
+from metrics     import Histogram
+from responses   import ResponseParser, GPXResponseParser
+from checkpoint  import Checkpoint, resume_commands
+from client      import Client, BurijjiError
+from x3gjob      import X3GJob, crc, frame, packet_length
+from x3g         import X3GPrinter
+from server      import BurijjiServer
+
+_fixture = """G21
+G90
+M82
+M104 S210
+M140 S60
+G28
+G1 Z0.3 F1200
+G1 X10 Y10 E1 F3000 ; first extrusion
+G1 X20 Y10 E2
+G91
+G1 X5 E0.5
+M83
+G1 Y5 E0.5"""
+
+class _SmallIndex(GCodeIndex):
+    stride = 4
+
+class _FixtureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'fixture.gcode')
+        with open(self.path, 'wb') as f:
+            f.write(_fixture)
+        self.lines     = _fixture.split('\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class GCodeSourceTest(_FixtureTest):
+    def setUp(self):
+        _FixtureTest.setUp(self)
+        self.source = GCodeSource(self.path, _SmallIndex.build(self.path))
+
+    def tearDown(self):
+        self.source.close()
+        _FixtureTest.tearDown(self)
+
+    def test_index(self):
+        # No newline after the last line, it counts all the same.
+        self.assertEqual(len(self.source), 13)
+        self.assertEqual(list(self.source.index.offsets), [_fixture.index(line) for line in self.lines[::4]])
+
+    def test_random_access(self):
+        for number in [12, 0, 7, 3, 8, -1]: self.assertEqual(self.source[number], self.lines[number].strip())
+        self.assertRaises(IndexError, lambda: self.source[13])
+
+    def test_iter_from(self):
+        for start in xrange(14): self.assertEqual(list(self.source.iter_from(start)), self.lines[start:])
+        self.assertEqual(list(self.source.iter_from(100)), [])
+        self.assertEqual(list(self.source), self.lines)
+
+    def test_state_at(self):
+        state = self.source.state_at(9)
+        self.assertEqual((state['x'], state['y'], state['z'], state['e']), (20.0, 10.0, 0.3, 2.0))
+        self.assertEqual(state['feedrate'], 3000.0)
+        self.assertEqual(state['temperatures'], {'t': 210.0, 'b': 60.0})
+        self.assertFalse(state['relative'] or state['relative_e'])
+
+        state = self.source.state_at(13)
+        self.assertEqual((state['x'], state['y'], state['e']), (25.0, 15.0, 3.0))
+        self.assertTrue(state['relative'] and state['relative_e'])
+        self.assertEqual(self.source.state_at(100), state)
+
+    def test_state_at_replays_from_a_sample(self):
+        # Without warm-up the replay starts at line 8, from the Z the index recorded there.
+        warmup = gcodesource._warmup_size
+        gcodesource._warmup_size = 0
+        try:
+            state = self.source.state_at(9)
+        finally:
+            gcodesource._warmup_size = warmup
+        self.assertEqual((state['x'], state['y'], state['e']), (20.0, 10.0, 2.0))
+        # Heights are kept as float32.
+        self.assertAlmostEqual(state['z'], 0.3, 6)
+
+class EstimatorTest(_FixtureTest):
+    def feed(self, estimator, lines):
+        for number, line in enumerate(lines): estimator.feed(number, line)
+
+    def test_move_times(self):
+        # 100 mm/s at 1500 mm/s^2: long moves cruise, short ones never reach the feedrate.
+        estimator = _Estimator(1000)
+        self.feed(estimator, ['G1 F6000', 'G1 X100'])
+        self.assertAlmostEqual(estimator.elapsed, 1.0 + 100 / 1500.0)
+        self.feed(estimator, ['G1 X101'])
+        self.assertAlmostEqual(estimator.elapsed, 1.0 + 100 / 1500.0 + 2 * math.sqrt(1 / 1500.0))
+        self.feed(estimator, ['G4 P500', 'G4 S2', 'M204 S3000', 'G1 X201'])
+        self.assertAlmostEqual(estimator.elapsed, 4.5 + 100 / 1500.0 + 2 * math.sqrt(1 / 1500.0) + 100 / 3000.0)
+
+    def test_layers_and_filament(self):
+        # Retractions, Z hops and extruding back at the same height start no layer.
+        estimator = _Estimator(2)
+        self.feed(estimator, ['G92 E0', 'G1 Z0.2', 'G1 X10 E1', 'G1 E0.5', 'G1 Z0.6', 'G1 Z0.2', 'G1 E1', 'G1 Z0.4', 'G1 X20 E2 ; two', 'G20', 'G1 X1'])
+        self.assertEqual((estimator.layer, estimator.extruded), (2, 2.0))
+        self.assertEqual(list(estimator.layers), [0, 0, 1, 1, 1, 2])
+        self.assertEqual(list(estimator.filament), [0.0, 0.0, 0.5, 0.5, 1.0, 2.0])
+        self.assertEqual(estimator.state()['x'], 25.4)
+
+    def test_progress(self):
+        with open(self.path, 'wb') as f:
+            f.write('\n'.join(['G1 F6000'] + ['G1 X%d E%d' % (100 * i, i) for i in xrange(1, 9)]) + '\n')
+        index = _SmallIndex.build(self.path)
+        self.assertEqual(index.progress(0)['percent'], 0.0)
+        # Between two samples the time is interpolated.
+        self.assertEqual(index.progress(5)['percent'], 50.0)
+        self.assertEqual(index.progress(5)['filament_used'], 4.0)
+        for line in [9, 20]: self.assertEqual((index.progress(line)['percent'], index.progress(line)['eta']), (100.0, 0))
+        self.assertEqual(index.progress(9)['filament_total'], 8.0)
+        self.assertEqual(index.progress(None), None)
+
+class TemperatureHistoryTest(unittest.TestCase):
+    def values(self, result):
+        first, step, count, heaters, values = result
+        return(list(struct.unpack('<%df' % (count * len(heaters)), values)))
+
+    def test_query(self):
+        history = TemperatureHistory()
+        history.record(1000.2, {'t': 200.0, 'b': 60.0})
+        history.record(1001.7, {'t': 201.0})
+        history.record(1003.0, {'t': 203.0})
+        result = history.query(1000, 1003)
+        self.assertEqual(result[:4], (1000, 1, 4, ['b', 't']))
+        b, t   = self.values(result)[:4], self.values(result)[4:]
+        self.assertEqual(b[0], 60.0)
+        self.assertTrue(all(math.isnan(value) for value in b[1:]))
+        self.assertEqual([t[0], t[1], t[3]], [200.0, 201.0, 203.0])
+        self.assertTrue(math.isnan(t[2]))
+
+    def test_coarser_tier(self):
+        # Past the 3 hours of the 1 s ring, slots hold the mean of their samples.
+        history = TemperatureHistory()
+        history.record(100000, {'t': 10.0})
+        history.record(100005, {'t': 20.0})
+        history.record(120000, {'t': 30.0})
+        result = history.query(100000, 100019, ['t'])
+        self.assertEqual(result[:4], (100000, 10, 2, ['t']))
+        self.assertEqual(self.values(result)[0], 15.0)
+
+    def test_unknown_heater(self):
+        history = TemperatureHistory()
+        history.record(50, {'t': 10.0})
+        self.assertTrue(all(math.isnan(value) for value in self.values(history.query(48, 50, ['b']))))
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        for seconds in [0.0001] * 9 + [0.01]: histogram.add(seconds)
+        self.assertEqual([histogram.percentile(fraction) for fraction in [0.5, 0.9, 0.99]], [128 / 1000000.0, 128 / 1000000.0, 0.01])
+
+    def test_single_sample(self):
+        # The sample's bucket reaches up to 1.048576 s, the percentiles stop at the sample.
+        histogram = Histogram()
+        histogram.add(0.6)
+        report    = histogram.report()
+        self.assertEqual((report['p50'], report['p90'], report['p99']), (0.6, 0.6, 0.6))
+
+class ResponseParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = ResponseParser()
+
+    def test_temperatures(self):
+        self.assertEqual(self.parser.parse('ok T:210.0 /210.0 B:60.0 /60.0 @:127 B@:0'),
+                         ('ok', {'t': 210.0, 'b': 60.0}, {'t': 210.0, 'b': 60.0}, None))
+        # M155 auto-reports come without an ok.
+        self.assertEqual(self.parser.parse(' T:205.31 /210.00 B:59.80 /60.00 @:64 B@:0'),
+                         ('other', {'t': 205.31, 'b': 59.8}, {'t': 210.0, 'b': 60.0}, None))
+        kind, temperatures, targets, info = self.parser.parse('ok T:210.0 /210.0 B:60.0 /60.0 T0:210.0 /210.0 T1:25.0 /0.0 @:0 B@:0 @0:0 @1:0')
+        self.assertEqual(temperatures, {'t': 210.0, 'b': 60.0, 't0': 210.0, 't1': 25.0})
+        self.assertEqual(targets, {'t': 210.0, 'b': 60.0, 't0': 210.0, 't1': 0.0})
+
+    def test_kinds(self):
+        for line, kind in [('ok', 'ok'), ('ok 0', 'ok'), ('Resend: 42', 'resend'), ('rs 42', 'resend'),
+                           ('Error:Line Number is not Last Line Number+1, Last Line: 41', 'error'), ('!! Printer halted', 'error'),
+                           ('echo:busy: processing', 'other')]:
+            self.assertEqual(self.parser.parse(line), (kind, None, None, None))
+
+    def test_firmware(self):
+        kind, temperatures, targets, info = self.parser.parse('FIRMWARE_NAME:Marlin 1.1.9 (Github) SOURCE_CODE_URL:https://github.com/MarlinFirmware/Marlin '
+                                                              'PROTOCOL_VERSION:1.0 MACHINE_TYPE:Prusa i3 EXTRUDER_COUNT:1 UUID:cede2a2f-41a2-4748-9b12-c55c62f367ff')
+        self.assertEqual(kind, 'firmware')
+        self.assertTrue(info['firmware_name'].startswith('Marlin 1.1.9'))
+        self.assertEqual((info['machine_type'], info['extruder_count'], info['uuid']), ('Prusa', 1, 'cede2a2f-41a2-4748-9b12-c55c62f367ff'))
+
+    def test_capability(self):
+        self.assertEqual(self.parser.parse('Cap:AUTOREPORT_TEMP:1'), ('capability', None, None, {'AUTOREPORT_TEMP': True}))
+        self.assertEqual(self.parser.parse('Cap:EEPROM:0'), ('capability', None, None, {'EEPROM': False}))
+
+    def test_gpx(self):
+        parser = GPXResponseParser()
+        self.assertEqual(parser.parse('Extruder T0 temperature: 210c'), ('other', {'t0': 210.0}, None, None))
+        self.assertEqual(parser.parse('Build platform B0 temperature: 60c'), ('other', {'b0': 60.0}, None, None))
+        self.assertEqual(parser.parse('ok'), ('ok', None, None, None))
+
+class ResumeTest(_FixtureTest):
+    state = {'x': 20.0, 'y': 10.0, 'z': 0.3, 'e': 2.0, 'feedrate': 3000.0, 'relative': False, 'relative_e': False,
+             'temperatures': {'t': 210.0, 'b': 60.0}}
+
+    def test_resume_commands(self):
+        self.assertEqual(resume_commands(self.state),
+                         ['M140 S60.0', 'M190 S60.0', 'M109 S210.0', 'G90', 'G92 Z0.300', 'G1 Z1.300', 'G28 X Y', 'G1 X20.000 Y10.000', 'G1 Z0.300',
+                          'M82', 'G92 E2.00000', 'G1 F3000.0'])
+
+    def test_routine_and_targets(self):
+        # The routine does the homing, targets fill in heaters the file didn't set.
+        state = dict(self.state, relative=True, relative_e=True, temperatures={'t': 210.0})
+        commands = resume_commands(state, {'b': 55.0, 't1': 200.0}, ['G28 X Y', 'M400'])
+        self.assertEqual(commands[:6], ['M140 S55.0', 'M190 S55.0', 'M109 S210.0', 'M109 T1 S200.0', 'G28 X Y', 'M400'])
+        self.assertEqual(commands.count('G28 X Y'), 1)
+        self.assertEqual(commands[-4:], ['M83', 'G92 E2.00000', 'G1 F3000.0', 'G91'])
+
+    def test_from_a_file(self):
+        source = GCodeSource(self.path, _SmallIndex.build(self.path))
+        try:
+            commands = resume_commands(source.state_at(9))
+        finally:
+            source.close()
+        self.assertEqual(commands[7:], ['G1 X20.000 Y10.000', 'G1 Z0.300', 'M82', 'G92 E2.00000', 'G1 F3000.0'])
+
+    def test_resumed_source(self):
+        # The preamble and the rest of the file are one job, numbered from the preamble's first line.
+        source  = GCodeSource(self.path, _SmallIndex.build(self.path))
+        resumed = ResumedSource(source, ['G92 Z0.3', 'G1 Z1.3'], 9)
+        try:
+            self.assertEqual(len(resumed), 6)
+            self.assertEqual(list(resumed), ['G92 Z0.3', 'G1 Z1.3'] + self.lines[9:])
+            self.assertEqual([resumed[index] for index in [1, 2, 5, -1]], ['G1 Z1.3', self.lines[9], self.lines[12], self.lines[12]])
+            self.assertEqual(list(resumed.iter_from(1)), list(resumed)[1:])
+            self.assertEqual(list(resumed.iter_from(4)), self.lines[11:])
+            self.assertEqual(resumed.all_layers[0][2].raw, self.lines[9])
+            self.assertEqual([resumed.line_at(index) for index in [0, 2, 3, 6]], [9, 9, 10, 13])
+            self.assertRaises(IndexError, resumed.__getitem__, 6)
+        finally:
+            resumed.close()
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint(os.path.join(self.directory, 'checkpoints', 'machine.json'))
+        self.assertEqual(checkpoint.load(), None)
+        checkpoint.save({'file': self.path, 'line': 9}, 100.0)
+        with checkpoint._writing: pass
+        self.assertEqual(checkpoint.load(), {'file': self.path, 'line': 9})
+        # Not due yet, unless forced.
+        checkpoint.save({'file': self.path, 'line': 10}, 101.0)
+        with checkpoint._writing: pass
+        self.assertEqual(checkpoint.load()['line'], 9)
+        checkpoint.save({'file': self.path, 'line': 10}, 101.0, force=True)
+        with checkpoint._writing: pass
+        self.assertEqual(checkpoint.load()['line'], 10)
+        checkpoint.clear()
+        self.assertEqual(checkpoint.load(), None)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'checkpoints')), [])
+
+class _SmallChunks(X3GJob):
+    _read_size = 7
+
+class X3GJobTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'job.x3g')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def marker(self, line):
+        return(chr(149) + '\0' * 4 + 'BJ:' + str(line) + '\0')
+
+    def write(self, x3g):
+        source = os.path.join(self.directory, 'job.out')
+        with open(source, 'wb') as f:
+            f.write(x3g)
+        with open(source, 'rb') as x3g, open(self.path, 'wb') as f:
+            _SmallChunks.write(f, 40, x3g, 'BJ:')
+        return(X3GJob.load(self.path))
+
+    def test_crc(self):
+        self.assertEqual(crc('123456789'), 0xA1)
+        self.assertEqual(frame(chr(22) + chr(3)), '\xd5\x02\x16\x03' + chr(crc(chr(22) + chr(3))))
+
+    def test_packet_length(self):
+        data = chr(133) + struct.pack('<I', 500) + chr(136) + '\0\x03\x02\0\0' + chr(149) + '\0' * 4 + 'hi\0'
+        self.assertEqual([packet_length(data, offset) for offset in [0, 5, 11]], [5, 6, 8])
+        for truncated in [chr(133) + '\0', chr(136) + '\0\x03', chr(136) + '\0\x03\x02\0', chr(149) + '\0' * 4 + 'hi']:
+            self.assertRaises(ValueError, packet_length, truncated, 0)
+        self.assertRaises(ValueError, packet_length, chr(200), 0)
+
+    def test_round_trip(self):
+        # Written 7 bytes at a time, so packets are cut by chunks all along.
+        packets = [chr(133) + struct.pack('<I', n) for n in range(100)] + [chr(149) + '\0' * 4 + 'done\0']
+        job     = self.write(self.marker(0) + ''.join(packets[:40]) + self.marker(16) + ''.join(packets[40:80]) + self.marker(32) + ''.join(packets[80:]))
+        self.assertEqual((len(job), job.packet_count), (40, 101))
+        self.assertEqual(list(job.packets()), [frame(packet) for packet in packets])
+        self.assertEqual([job.line_at(packet) for packet in [0, 39, 40, 79, 80, 100]], [0, 0, 16, 16, 32, 32])
+
+    def test_truncated(self):
+        x3g = self.marker(0) + (chr(133) + '\0' * 4) * 100 + chr(133) + '\0'
+        with self.assertRaises(ValueError) as raised:
+            self.write(x3g)
+        self.assertEqual(str(raised.exception), 'Truncated x3g packet at byte %d' % (len(x3g) - 2))
+
+class _FakeSerial:
+    """A bot answering each packet written with the next of `responses`: a
+    payload to frame, '' for no answer at all or a function returning either.
+    Past the script every packet succeeds."""
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.packets   = []
+        self.pending   = ''
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, packet):
+        self.packets.append(packet[2:-1])
+        response      = self.responses.pop(0) if self.responses else chr(0x81)
+        if callable(response): response = response()
+        self.pending += frame(response) if response else ''
+
+    def read(self, size):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return(data)
+
+class _ExitedGPX:
+    """A gpx that has let go of the serial port."""
+    def __init__(self):
+        self.stdin  = None
+        self.stdout = open(os.devnull)
+        self.stderr = open(os.devnull)
+
+    def poll(self):
+        return(0)
+
+    def kill(self):
+        pass
+
+    def wait(self):
+        return(0)
+
+class _Job:
+    """The part of an X3GJob _stream reads, a packet per line."""
+    def __init__(self, payloads):
+        self.payloads     = payloads
+        self.packet_count = len(payloads)
+
+    def __len__(self):
+        return(len(self.payloads))
+
+    def packets(self):
+        return(frame(payload) for payload in self.payloads)
+
+    def line_at(self, packet):
+        return(packet)
+
+class _StreamingPrinter(X3GPrinter):
+    """An X3GPrinter without gpx or a thread of its own: the tests call _stream and _transact themselves."""
+    def __init__(self, baud=115200, port='/dev/bot0', settings={}):
+        X3GPrinter.__init__(self, baud, port, settings)
+        self.config_file    = None
+        self.gpx            = _ExitedGPX()
+        self.diagnostics    = []
+        self.completed      = 0
+        self.on_diagnostics = self.diagnostics.extend
+        self.on_complete    = self._completed
+
+    def _run(self):
+        pass
+
+    def _start_gpx(self, config_file):
+        pass
+
+    def _completed(self):
+        self.completed += 1
+
+    def close(self):
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+def _action(value):
+    return(chr(133) + struct.pack('<I', value))
+
+class X3GStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.printer = _StreamingPrinter()
+        self.addCleanup(self.printer.close)
+
+    def stream(self, payloads, responses):
+        bot              = _FakeSerial(responses)
+        opened           = serial.Serial
+        serial.Serial    = lambda **settings: bot
+        self.printer.send_job(_Job(payloads))
+        try:
+            self.printer._stream(self.printer.job)
+        finally:
+            serial.Serial = opened
+        return(bot.packets)
+
+    def transact(self, payload, responses):
+        self.printer.serial = _FakeSerial(responses)
+        return(self.printer._transact(frame(payload)), self.printer.serial.packets)
+
+    def room(self, size):
+        return(chr(0x81) + struct.pack('<I', size))
+
+    def test_buffer_full(self):
+        # The buffer is polled until the packet fits, then it's sent again.
+        self.assertEqual(self.transact(_action(1), [chr(0x82), self.room(2), self.room(500)]),
+                         (chr(0x81), [_action(1), chr(2), chr(2), _action(1)]))
+
+    def test_retry_codes(self):
+        self.assertEqual(self.transact(_action(1), [chr(0x83), chr(0x89)]), (chr(0x81), [_action(1)] * 3))
+        self.assertEqual(self.transact(_action(1), [chr(0x84)]), (None, [_action(1)]))
+
+    def test_timeouts(self):
+        # An action might have run all the same, a query is harmless to repeat.
+        self.assertEqual(self.transact(_action(1), ['']), (None, [_action(1)]))
+        self.assertEqual(self.transact(chr(2), ['', self.room(500)]), (self.room(500), [chr(2)] * 2))
+        self.assertEqual(self.transact(chr(2), [''] * 5), (None, [chr(2)] * 5))
+
+    def test_temperature_queries(self):
+        self.printer.serial = _FakeSerial([chr(0x81) + struct.pack('<h', 210), chr(0x81) + struct.pack('<h', 60)])
+        self.printer._query_temperatures()
+        self.assertEqual(self.printer.serial.packets, ['\x0a\x00\x02', '\x0a\x00\x1e'])
+        self.assertEqual(self.printer.diagnostics, ['Extruder T0 temperature: 210c', 'Build platform B0 temperature: 60c'])
+
+    def test_stream(self):
+        payloads = [_action(n) for n in range(5)]
+        self.assertEqual(self.stream(payloads, []), payloads)
+        self.assertEqual((self.printer.completed, self.printer.ok, self.printer.job, self.printer.queueindex), (1, True, None, 5))
+
+    def test_stop_during_stream(self):
+        # The stop goes out between two packets, on its own, and ends the job.
+        payloads = [_action(n) for n in range(5)]
+        stop     = lambda: self.printer.send_priority('M112') or chr(0x81)
+        self.assertEqual(self.stream(payloads, [chr(0x81), stop]), payloads[:2] + [chr(22) + chr(3)])
+        self.assertEqual((self.printer.completed, self.printer.ok, self.printer.stream_stopped, self.printer.job), (0, True, True, None))
+
+    def test_stop_while_buffer_full(self):
+        payloads = [_action(n) for n in range(5)]
+        stop     = lambda: self.printer.send_priority('M112') or self.room(0)
+        self.assertEqual(self.stream(payloads, [chr(0x82), stop]), [payloads[0], chr(2), chr(22) + chr(3)])
+        self.assertEqual((self.printer.completed, self.printer.ok, self.printer.stream_stopped), (0, True, True))
+
+    def test_timeout_during_stream(self):
+        payloads = [_action(n) for n in range(5)]
+        self.assertEqual(self.stream(payloads, [chr(0x81), '']), payloads[:2])
+        self.assertEqual((self.printer.completed, self.printer.ok, self.printer.job), (0, False, None))
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path           = os.path.join(self.directory, 'burijji.sock')
+        listener       = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        self.client    = Client(path, timeout=0.5)
+        self.server    = listener.accept()[0]
+        self.unpacker  = msgpack.Unpacker()
+        listener.close()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def requests(self):
+        self.unpacker.feed(self.server.recv(65536))
+        return(list(self.unpacker))
+
+    def reply(self, *messages):
+        for message in messages: self.server.sendall(msgpack.packb(message))
+
+    def test_replies_out_of_order(self):
+        first  = self.client.send('machine_info', machine='ttyACM0')
+        second = self.client.send('stats')
+        self.assertEqual(self.requests(), [{'action': 'machine_info', 'data': '', 'id': first, 'machine': 'ttyACM0'},
+                                           {'action': 'stats', 'data': '', 'id': second}])
+        self.reply({'action': 'stats', 'data': 2, 'id': second}, {'action': 'temperature', 'data': {'t': 20.0}},
+                   {'action': 'machine_info', 'data': 1, 'id': first})
+        self.assertEqual(self.client.wait(second)['data'], 2)
+        self.assertEqual(self.client.wait(first)['data'], 1)
+        self.assertEqual(list(self.client.messages(timeout=0)), [{'action': 'temperature', 'data': {'t': 20.0}}])
+
+    def test_unknown_ids_are_messages(self):
+        # A reply nobody waits for (or sent to another client's id) isn't swallowed.
+        self.reply({'action': 'ack', 'data': 'print_file', 'id': 99})
+        self.assertEqual(list(self.client.messages(timeout=0.1)), [{'action': 'ack', 'data': 'print_file', 'id': 99}])
+
+    def test_errors_and_timeouts(self):
+        self.reply({'action': 'data_error', 'data': 'Malformed data.', 'id': 1})
+        self.assertRaises(BurijjiError, self.client.request, 'send_commands', 'G28')
+        self.assertRaises(socket.timeout, self.client.request, 'machine_info', timeout=0.05)
+
+    def test_pipeline(self):
+        self.reply({'action': 'ack', 'data': 'a', 'id': 2}, {'action': 'ack', 'data': 'b', 'id': 1})
+        self.assertEqual([reply['data'] for reply in self.client.pipeline([('b',), ('a', 'x')])], ['b', 'a'])
+
+    def test_delta_subscribe(self):
+        # The snapshot a delta subscription replies with belongs to the stream too.
+        snapshot = {'action': 'temperature', 'machine': 'm', 'data': {'t': 20.0}, 'version': 3, 'id': 1}
+        self.reply(snapshot)
+        self.assertEqual(self.client.subscribe('temperature', delta=True), snapshot)
+        self.assertEqual(list(self.client.messages(timeout=0)), [snapshot])
+
+    def test_version_gap(self):
+        # Version 3 went missing: the client subscribes again, once, and the fresh snapshot is just another message.
+        self.reply(*[{'action': 'temperature', 'machine': 'm', 'data': {}, 'version': version, 'delta': True} for version in [1, 2, 4, 5, 7]])
+        self.assertEqual(len(list(self.client.messages(timeout=0.1))), 5)
+        self.assertEqual(self.requests(), [{'action': 'subscribe', 'data': {'type': 'temperature', 'delta': True}, 'machine': 'm', 'id': 1}])
+        self.reply({'action': 'temperature', 'machine': 'm', 'data': {'t': 20.0}, 'version': 7, 'id': 1})
+        self.assertEqual([message.get('id') for message in self.client.messages(timeout=0.1)], [1])
+        self.assertEqual((self.client._replies, self.client._waiting), ({}, set()))
+
+class _StubMachine:
+    """Stands in for repWrapper/mbWrapper, like bench/protocol_bench.py's."""
+    def __init__(self, server, port, baud, protocol):
+        self._server     = server
+        self.port        = port
+        self.protocol    = protocol['protocol']
+        self.machine_id  = port.split('/')[-1]
+        self.subscribers = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        return({})
+
+    def machine_info(self, fileno, data):
+        self._server.add_to_queue(fileno, {'action': 'machine_info', 'machine': self.machine_id, 'data': data})
+
+    def send_commands(self, fileno, data):
+        raise ValueError(data)
+
+    def subscribe(self, fileno, data):
+        self.subscribers.append(fileno)
+
+    def unsubscribe(self, fileno, data):
+        while fileno in self.subscribers: self.subscribers.remove(fileno)
+
+class _ServerTest(unittest.TestCase):
+    """A BurijjiServer hosting a _StubMachine, on a socket in a temporary directory."""
+    options = {'index_workers': 0}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'burijji.sock')
+        BurijjiServer._machine_types['stub'] = _StubMachine
+        self.server    = BurijjiServer(None, self.path, None, None, cache_dir=os.path.join(self.directory, 'cache'), **self.options)
+        self.machine   = self.server.add_machine('/dev/stub0', 0, {'protocol': 'stub'})
+        self.unpackers = {}
+        self.server.start()
+        self.addCleanup(self.stop)
+        while not os.path.exists(self.path): time.sleep(0.01)
+        self.client    = self.connect()
+
+    def stop(self):
+        self.server.stop()
+        while os.path.exists(self.path): time.sleep(0.01)
+        del BurijjiServer._machine_types['stub']
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.path)
+        connection.settimeout(2)
+        self.unpackers[connection] = msgpack.Unpacker()
+        self.assertEqual(self.receive(connection)['action'], 'server_info')
+        return(connection)
+
+    def send(self, *messages):
+        for message in messages: self.client.sendall(msgpack.packb(message))
+
+    def receive(self, connection=None):
+        connection = connection or self.client
+        unpacker   = self.unpackers[connection]
+        for message in unpacker: return(message)
+        while True:
+            unpacker.feed(connection.recv(65536))
+            for message in unpacker: return(message)
+
+class ServerProtocolTest(_ServerTest):
+    def test_ids(self):
+        self.send({'action': 'machine_info', 'machine': 'stub0', 'data': 'x', 'id': 7}, {'action': 'machine_info', 'machine': '/dev/stub0', 'data': 'y'})
+        self.assertEqual(self.receive(), {'action': 'machine_info', 'machine': 'stub0', 'data': 'x', 'id': 7})
+        self.assertEqual(self.receive(), {'action': 'machine_info', 'machine': 'stub0', 'data': 'y'})
+
+    def test_ack(self):
+        # Only requests with an id get one.
+        self.send({'action': 'subscribe', 'machine': 'stub0', 'data': ''}, {'action': 'unsubscribe', 'machine': 'stub0', 'data': '', 'id': 1})
+        self.assertEqual(self.receive(), {'action': 'ack', 'data': 'unsubscribe', 'id': 1})
+
+    def test_errors(self):
+        self.send({'action': 'machine_info', 'machine': 'stub1', 'data': '', 'id': 1}, {'action': 'fly', 'machine': 'stub0', 'data': '', 'id': 2},
+                  {'action': 'machine_info', 'id': 3}, [1, 2], {'action': 'machine_info', 'machine': 'stub0', 'data': '', 'id': 4})
+        self.assertEqual([self.receive() for reply in range(5)],
+                         [{'action': 'machine_error', 'data': 'Unknown machine.', 'id': 1}, {'action': 'action_error', 'data': 'Invalid action.', 'id': 2},
+                          {'action': 'data_error', 'data': 'Malformed data.', 'id': 3}, {'action': 'data_error', 'data': 'Malformed data.'},
+                          {'action': 'machine_info', 'machine': 'stub0', 'data': '', 'id': 4}])
+
+    def test_handler_exception(self):
+        # The loop carries on after a handler raised.
+        self.send({'action': 'send_commands', 'machine': 'stub0', 'data': 'G28', 'id': 1}, {'action': 'machine_info', 'machine': 'stub0', 'data': '', 'id': 2})
+        self.assertEqual(self.receive(), {'action': 'data_error', 'data': 'Malformed data.', 'id': 1})
+        self.assertEqual(self.receive()['id'], 2)
+
+class BackpressureTest(_ServerTest):
+    options = {'index_workers': 0, 'high_water_mark': 10, 'slow_consumer_policies': {'info': 'sample', 'info_delta': 'disconnect'}}
+
+    def subscriber(self, connection):
+        # The stub keeps the server side fileno of whoever subscribed.
+        connection.sendall(msgpack.packb({'action': 'subscribe', 'machine': 'stub0', 'data': '', 'id': 1}))
+        self.assertEqual(self.receive(connection)['action'], 'ack')
+        return(self.machine.subscribers[-1])
+
+    def backlog(self, fileno):
+        # Replies are always queued: megabytes of them fill the socket and leave the queue well above the mark.
+        for n in range(1000): self.server.broadcast([fileno], {'action': 'filler', 'data': 'x' * 4096})
+
+    def test_policies(self):
+        fileno = self.subscriber(self.client)
+        self.backlog(fileno)
+        for n in range(1, 6):  self.server.broadcast([fileno], {'action': 'temperature', 'data': n}, 'temperature')
+        for n in range(3):     self.server.broadcast([fileno], {'action': 'raw', 'data': n}, 'raw')
+        for n in range(1, 21): self.server.broadcast([fileno], {'action': 'info', 'data': n}, 'info')
+        messages = []
+        while not messages or messages[-1]['action'] != 'messages_dropped': messages.append(self.receive())
+        self.assertEqual(len([message for message in messages if message['action'] == 'filler']), 1000)
+        self.assertEqual([message for message in messages if message['action'] != 'filler'],
+                         [{'action': 'info', 'data': 10}, {'action': 'info', 'data': 20}, {'action': 'temperature', 'data': 5},
+                          {'action': 'messages_dropped', 'data': {'temperature': 4, 'raw': 3, 'info': 18}}])
+
+    def test_disconnect(self):
+        fileno = self.subscriber(self.client)
+        self.backlog(fileno)
+        self.server.broadcast([fileno], {'action': 'info', 'data': 0}, 'info_delta')
+        received = ''
+        while True:
+            data = self.client.recv(65536)
+            if not data: break
+            received += data
+        self.assertTrue(len(received) < 1000 * 4096)
+
+class IndexPoolTest(_ServerTest):
+    options = {'index_workers': 2}
+
+    def test_closed_connection_after_index_build(self):
+        # The workers were forked before anything was open, so they don't hold this pair's ends.
+        path = os.path.join(self.directory, 'big.gcode')
+        with open(path, 'wb') as f:
+            f.write('\n'.join([_fixture] * 500))
+        ours, theirs = socket.socketpair()
+        threshold    = GCodeIndex.parallel_threshold, GCodeIndex.parallel_chunk
+        GCodeIndex.parallel_threshold, GCodeIndex.parallel_chunk = 4096, 4096
+        try:
+            self.send({'action': 'prepare_file', 'data': path, 'id': 1})
+            reply = self.receive()
+        finally:
+            GCodeIndex.parallel_threshold, GCodeIndex.parallel_chunk = threshold
+        self.assertEqual((reply['action'], reply['data']['lines']), ('file_prepared', 6500))
+        theirs.close()
+        ours.settimeout(2)
+        self.assertEqual(ours.recv(1), '')
+        ours.close()
+
+class MakerBotStreamTest(_ServerTest):
+    def setUp(self):
+        _ServerTest.setUp(self)
+        printer                = mbWrapper.X3GPrinter
+        mbWrapper.X3GPrinter   = _StreamingPrinter
+        try:
+            self.bot           = self.server.add_machine('/dev/bot0', 115200, {'protocol': 'x3g', 'x3g_settings': {}})
+        finally:
+            mbWrapper.X3GPrinter = printer
+        self.printer           = self.bot._mbWrapper__printer
+        self.printer.job       = _Job([_action(n) for n in range(5)])
+        self.addCleanup(self.printer.close)
+
+    def test_pause_and_resume(self):
+        self.send({'action': 'pause_print', 'machine': 'bot0', 'data': '', 'id': 1}, {'action': 'resume_print', 'machine': 'bot0', 'data': '', 'id': 2})
+        self.assertEqual([(reply['action'], reply['id']) for reply in [self.receive(), self.receive()]], [('pause_error', 1), ('resume_error', 2)])
+
+    def test_emergency_stop(self):
+        # Left to the thread streaming the job, which sends it between two packets.
+        self.send({'action': 'emergency_stop', 'machine': 'bot0', 'data': '', 'id': 1})
+        self.assertEqual((self.receive()['action'], list(self.printer.stops)), ('ack', ['M112']))
+
+if __name__ == '__main__':
+    unittest.main()
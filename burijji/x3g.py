@@ -1,46 +1,166 @@
 
-import Queue
+import itertools
 import os
+import errno
+import fcntl
+import select
 import threading
 import time
 import subprocess
-import sys
 import tempfile
+import struct
+import serial
+from collections import deque
+from metrics import Histogram, RateCounter, TimedLock
+from x3gjob import frame, crc
+
+def _gpx_path():
+  return os.getenv("HOME") + '/Burijji/GPX/gpx'
 
 class X3GPrinter:
+  # Commands can be sent ahead of their oks, up to a window grown by one
+  # line per window's worth of quick oks and halved when oks slow down (the
+  # MakerBot's buffer is full and lines are queueing in gpx), at most once
+  # per window. gpx reads its input in order, so an M112 from
+  # send_priority waits behind everything in the window: by default a line
+  # is only sent once the previous one was acknowledged, the x3g settings
+  # can raise max_window to trade stop latency for throughput.
+  min_window = 1
+  max_window = 1
+  slow_ok = 4
+
+  # s3g response codes: success, buffer full, the ones worth a retry.
+  _success = 0x81
+  _buffer_full = 0x82
+  _retry = (0x80, 0x83, 0x88, 0x89, 0x8C)
+  # Commands below are host queries, answered without touching the machine.
+  _first_action = 128
+  _retries = 5
+  # While a compiled job streams gpx isn't there to translate: temperature
+  # queries and these are answered straight away, every other command
+  # waits in the queue until gpx is back.
+  _stream_commands = {'M112': chr(22) + chr(3)}
+
   def __init__(self, baud, port, settings):
     self.baud = baud
     self.port = port
 
-    self.lock = threading.Lock()
+    self.lock = TimedLock()
+    self.write_lock = threading.Lock()
+    # _run sleeps in select() on gpx's stdout and stderr and this pipe, which
+    # gets a byte whenever a command is queued, the print changed or we're
+    # stopping.
+    self._wake_r, self._wake_w = os.pipe()
+    for fd in (self._wake_r, self._wake_w):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    # Partial last line of each gpx pipe, and the whole lines read from
+    # stdout (responses) and stderr (gpx's log) since the last _read().
+    self._partial = {}
+    self._responses = []
+    self._diagnostics = []
     self.running = True
+    # Responses (gpx's stdout) and gpx's log (stderr), in batches.
     self.on_receive = self._null_on_receive
+    self.on_diagnostics = self._null_on_diagnostics
     self.on_complete = self._null_on_complete
     self.gpx = None
     self.ok = True
     self.ready = False
     self.is_sending_many = False
 
-    self.waiting_for_ok = False
-    self.commands_to_send = []
+    # (command, sent at, priority, print index or None) for every line written
+    # that has no ok yet, oldest first.
+    self.in_flight = deque()
+    self.max_window = int(settings.get('max_window', self.max_window))
+    self.window = float(self.min_window)
+    self.base_latency = None
+    self.acked = 0
+    self.decreased_at = 0
+
+    # Two lanes: interactive commands go ahead of the print, which is only
+    # ever an iterator and the count of lines taken from it.
+    self.commands_to_send = deque()
+    self.print_lines = iter([])
     self.print_queue_size = 0
+    self.print_index = 0
+    self.job = None
+    self.serial = None
+    # Stops (M112) from send_priority while a compiled job streams, sent by
+    # the loop thread between two packets. Once one went out the stream is
+    # over.
+    self.stops = deque()
+    self.stream_stopped = False
 
     self.settings = settings
 
+    self.lines_sent = RateCounter()
+    self.ok_latency = Histogram()
+    # From send_priority to gpx acknowledging the command, time spent
+    # behind the window included.
+    self.priority_latency = Histogram()
+    self.packets_sent = RateCounter()
+    self.failures = 0
+
     threading.Thread(target=self._run).start()
 
   def send_now(self, commands):
     with self.lock:
       if type(commands) is list:
-        self.commands_to_send = commands + self.commands_to_send
+        self.commands_to_send.extendleft(reversed(commands))
       else:
-        self.commands_to_send.insert(0, commands.strip())
+        self.commands_to_send.appendleft(commands.strip())
+    self._wake()
+
+  def send_priority(self, command):
+    # Control commands (M112) go to gpx right away: no queue, no waiting for
+    # the previous ok and no self.lock, only write_lock so they can't split
+    # another line in two. While a compiled job streams, or is about to,
+    # they're left to the loop thread.
+    if self.gpx is None:
+      return self.send_now(command)
+    if self.job is not None:
+      if command.split(';')[0].strip() not in self._stream_commands:
+        return self.send_now(command)
+      self.stops.append(command.strip())
+      return self._wake()
+    try:
+      with self.write_lock:
+        sent_at = time.time()
+        self.gpx.stdin.write(command.strip() + "\n")
+        self.in_flight.append((command.strip(), sent_at, True, None))
+    except IOError as io:
+      print "X3G / IOError writing '" + command.strip() + "'", io
+      self.ok = False
 
-  def send_many(self, lines):
+  def send_many(self, lines, start=0):
+    # lines only needs len() and iteration, a GCodeSource is read as it is sent
+    # and seeks straight to `start` instead of reading the lines before it.
     with self.lock:
       self.print_queue_size = len(lines)
+      self.print_index = start
+      if not start:                     self.print_lines = iter(lines)
+      elif hasattr(lines, 'iter_from'): self.print_lines = lines.iter_from(start)
+      else:                             self.print_lines = itertools.islice(lines, start, None)
+      self.is_sending_many = self.print_queue_size > start
+    self._wake()
+
+  def compile(self, source, cache):
+    # Blocks for as long as gpx takes over the whole file, call it from a
+    # thread of its own.
+    config_file = self._create_config_file(self.settings)
+    try:
+      return cache.job_for(source, self.settings, [_gpx_path(), '-r', '-c', config_file])
+    finally:
+      os.remove(config_file)
+
+  def send_job(self, job):
+    # An X3GJob is streamed to the bot as it is, packet by packet, by _run.
+    with self.lock:
+      self.job = job
+      self.print_queue_size = len(job)
+      self.print_index = 0
       self.is_sending_many = True
-      self.commands_to_send = [l.strip() for l in lines]
+    self._wake()
 
   def _create_config_file(self, config):
     config_file = tempfile.mktemp('.ini')
@@ -66,102 +186,351 @@ class X3GPrinter:
     f.close()
     return config_file
 
-  def _null_on_receive(self, line):
-    print "on_receive:", line
+  def _null_on_receive(self, lines):
+    print "on_receive:", lines
+
+  def _null_on_diagnostics(self, lines):
+    print "on_diagnostics:", lines
 
   def _null_on_complete(self):
     print "on_complete"
 
   def _run(self):
-    config_file = self._create_config_file(self.settings)
+    self._start_gpx(self._create_config_file(self.settings))
+
+    while self.running:
+      self._wait()
+      self._read()
+      if self.job is not None:
+        self._stream(self.job)
+        continue
+      self._write()
+      self._check_for_exit()
+
+    if self.gpx.poll() is None:
+      self.gpx.kill()
+    wake_r, wake_w = self._wake_r, self._wake_w
+    self._wake_w = None
+    os.close(wake_r)
+    os.close(wake_w)
 
-    gpx_command = [os.getenv("HOME") + '/Burijji/GPX/gpx', '-i', '-s', '-v', '-r', '-c', config_file, '-b', str(self.baud), self.port]
+  def _start_gpx(self, config_file):
+    self.config_file = config_file
+    gpx_command = [_gpx_path(), '-i', '-s', '-v', '-r', '-c', config_file, '-b', str(self.baud), self.port]
     print " ".join(gpx_command)
     self.gpx = subprocess.Popen(gpx_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-    self.read_queue = Queue.Queue()
-    read_thread = threading.Thread(target=self._threaded_read_from_gpx, args=(self.gpx.stdout, self.read_queue))
-    read_thread.daemon = True # Don't wait for this to be done on exit
-    read_thread.start()
-
-    read_thread = threading.Thread(target=self._threaded_read_from_gpx, args=(self.gpx.stderr, self.read_queue))
-    read_thread.daemon = True # Don't wait for this to be done on exit
-    read_thread.start()
+    self._partial = {}
+    for stream in (self.gpx.stdout, self.gpx.stderr):
+      fcntl.fcntl(stream.fileno(), fcntl.F_SETFL, fcntl.fcntl(stream.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
+      self._partial[stream.fileno()] = ''
 
     time.sleep(3)
     self.ready = True
     print "X3G Ready"
 
-    while self.running:
+  def _stream(self, job):
+    # gpx has the serial port open, it goes once the lines it was sent are
+    # acknowledged (or after its own timeout) and comes back when the job
+    # is done.
+    deadline = time.time() + 20
+    self.stream_stopped = False
+    while self.in_flight and self.running and not self.stops and self.gpx.poll() is None and time.time() < deadline:
+      self._wait(0.5)
       self._read()
-      self._write()
-      self._check_for_exit()
-
-    self.gpx.kill()
+    self.ready = False
+    if self.gpx.poll() is None:
+      self.gpx.kill()
+    self.gpx.wait()
+    self._partial = {}
+    self.gpx.stdout.close()
+    self.gpx.stderr.close()
+    self.in_flight.clear()
 
-  def _threaded_read_from_gpx(self, stream, queue):
-    for line in iter(stream.readline, b''):
-      queue.put(line.strip())
-      sys.stdout.flush()
+    try:
+      # Opened with DTR low, raising it would reset the bot's board.
+      self.serial = serial.Serial(baudrate=self.baud, timeout=1)
+      self.serial.port = self.port
+      self.serial.dtr = False
+      self.serial.open()
+      print "X3G streaming", job.packet_count, "packets"
+      for sent, packet in enumerate(job.packets()):
+        if self._serve_commands() or not self.running or self.job is not job:
+          break
+        if self._transact(packet) is None:
+          if self.stream_stopped:
+            break
+          print "X3G / streaming stopped at packet", sent
+          self.ok = False
+          break
+        self.packets_sent.add()
+        self.print_index = job.line_at(sent)
+    except (serial.SerialException, OSError) as e:
+      print "X3G / could not stream to '" + self.port + "'", e
+      self.ok = False
+    finally:
+      if self.serial is not None:
+        self.serial.close()
+      self.serial = None
 
-      if not self.running:
+    with self.lock:
+      completed = self.job is job and self.ok and not self.stream_stopped
+      self.job = None
+      self.is_sending_many = False
+      if completed:
+        self.print_index = self.print_queue_size
+    if self.running:
+      self._start_gpx(self.config_file)
+    # Stops that came in too late for the stream.
+    while self.stops:
+      self.send_priority(self.stops.popleft())
+    if completed and self.on_complete != None:
+      self.on_complete()
+
+  def _serve_commands(self):
+    # True once a stop went out.
+    with self.lock:
+      commands = list(self.commands_to_send)
+      self.commands_to_send.clear()
+    kept = []
+    for command in commands:
+      if command.split(';')[0].strip() == 'M105':
+        self._query_temperatures()
+      elif command.split(';')[0].strip() in self._stream_commands:
+        self.stops.append(command)
+      else:
+        kept.append(command)
+    if kept:
+      with self.lock:
+        self.commands_to_send.extendleft(reversed(kept))
+    return self._send_stops()
+
+  def _query_temperatures(self):
+    # Reported in the words of gpx's verbose log, as if gpx had logged them.
+    lines = []
+    for query, line in [(2, "Extruder T0 temperature: %dc"), (30, "Build platform B0 temperature: %dc")]:
+      response = self._transact(frame(struct.pack('<BBB', 10, 0, query)))
+      if response is not None and len(response) >= 3:
+        lines.append(line % struct.unpack('<h', response[1:3]))
+    if lines:
+      self.on_diagnostics(lines)
+
+  def _send_stops(self):
+    # Each its own transaction, so no response is read as another packet's.
+    while self.stops:
+      self._transact(frame(self._stream_commands[self.stops.popleft().split(';')[0].strip()]))
+      self.stream_stopped = True
+    return self.stream_stopped
+
+  def _transact(self, packet):
+    # Sends one framed packet, returns the response payload or None if the
+    # bot refused it. A full buffer isn't a failure, the buffer is polled
+    # until there's room for the packet and it is sent again, unless a stop
+    # came in meanwhile. Without a response the bot may have run the packet
+    # all the same: only queries, which change nothing, are sent again.
+    retries = 0
+    while retries < self._retries and self.running:
+      sent_at = time.time()
+      with self.write_lock:
+        self.serial.write(packet)
+      response = self._read_response()
+      if response is None:
+        if ord(packet[2]) >= self._first_action:
+          print "X3G / no response to command %d, not sending it twice" % ord(packet[2])
+          return None
+        retries += 1
+        continue
+      code = ord(response[0])
+      if code == self._success:
+        self.ok_latency.add(time.time() - sent_at)
+        return response
+      if code == self._buffer_full:
+        self._wait_for_room(len(packet) - 3)
+        if self._send_stops():
+          return None
+        continue
+      if code not in self._retry:
+        print "X3G / packet refused with response code 0x%02X" % code
+        return None
+      retries += 1
+      time.sleep(0.1)
+    return None
+
+  def _wait_for_room(self, length):
+    while self.running and not self.stops:
+      time.sleep(0.1)
+      response = self._transact(frame(chr(2)))
+      if response is None or len(response) < 5 or struct.unpack('<I', response[1:5])[0] >= length:
+        return
+
+  def _read_response(self):
+    # D5, length, payload, crc. None on a timeout or a damaged packet.
+    while True:
+      byte = self.serial.read(1)
+      if not byte:
+        return None
+      if byte == '\xd5':
         break
+    length = self.serial.read(1)
+    if not length:
+      return None
+    payload = self.serial.read(ord(length) + 1)
+    if len(payload) != ord(length) + 1 or crc(payload[:-1]) != ord(payload[-1]):
+      return None
+    return payload[:-1]
+
+  def _wake(self):
+    try:
+      os.write(self._wake_w, 'x')
+    except (OSError, TypeError):
+      pass # A wakeup is pending already, or we've stopped.
+
+  def _wait(self, timeout=None):
+    # Sleeps until gpx writes something or _wake() is called. Wakeups are
+    # drained before the work, not after, so one that comes in while we
+    # work isn't lost and the next wait returns straight away.
+    try:
+      readable = select.select([self._wake_r] + self._partial.keys(), [], [], timeout)[0]
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        return
+      raise
+    for fd in readable:
+      if fd == self._wake_r:
+        try:
+          while os.read(self._wake_r, 4096): pass
+        except OSError:
+          pass
+      else:
+        self._read_from(fd)
 
-    stream.close()
+  def _read_from(self, fd):
+    # One big read, split into lines in bulk. stdout carries gpx's replies
+    # to our commands, stderr its verbose log (temperatures among it).
+    try:
+      data = os.read(fd, 65536)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return
+      raise
+    if not data:
+      # gpx closed its end, most likely it exited; _check_for_exit will see it.
+      del self._partial[fd]
+      return
+    lines = (self._partial[fd] + data).split('\n')
+    self._partial[fd] = lines.pop()
+    if fd == self.gpx.stdout.fileno():
+      self._responses.extend(line.strip() for line in lines)
+    else:
+      self._diagnostics.extend(line.strip() for line in lines)
 
   def _read(self):
-    try:
+    # Everything that came in since the last wakeup, handed on in batches.
+    responses, self._responses = self._responses, []
+    diagnostics, self._diagnostics = self._diagnostics, []
+    if responses:
       with self.lock:
-        read_line = self.read_queue.get_nowait()
-
-        if read_line.strip() == "ok":
-          self.waiting_for_ok = False
-
-        if read_line.strip() == "fail":
-          self.ok = False
+        for line in responses:
+          if line == "ok" and self.in_flight:
+            command, sent_at, priority, index = self.in_flight.popleft()
+            latency = time.time() - sent_at
+            self._acknowledged(latency)
+            if priority:
+              self.priority_latency.add(latency)
+
+          if line == "fail":
+            self.ok = False
+            self.failures += 1
+            self.window = float(self.min_window)
+            if self.in_flight: self.in_flight.popleft()
+
+    for callback, lines in ((self.on_receive, responses), (self.on_diagnostics, diagnostics)):
+      if not lines:
+        continue
+      try:
+        callback(lines)
+      except Exception as e:
+        print "_run exception", e
+        self.ok = False
 
-      self.on_receive(read_line)
-    except Queue.Empty:
-      pass
-    except Exception as e:
-      print "_run exception", e
-      self.ok = False
+  def _acknowledged(self, latency):
+    self.ok_latency.add(latency)
+    self.acked += 1
+    if self.base_latency is None or latency < self.base_latency:
+      self.base_latency = latency
+    if latency > self.slow_ok * self.base_latency + 0.001:
+      if self.acked - self.decreased_at >= self.window:
+        self.window = max(float(self.min_window), self.window / 2)
+        self.decreased_at = self.acked
+    else:
+      self.window = min(float(self.max_window), self.window + 1 / self.window)
 
   def _write(self):
+    completed = False
     with self.lock:
-      if (not self.waiting_for_ok) and len(self.commands_to_send) > 0:
-        command_to_send = self.commands_to_send[0]
-        del self.commands_to_send[0]
+      while len(self.in_flight) < int(self.window):
+        line = None
+        if self.commands_to_send:
+          command_to_send = self.commands_to_send.popleft()
+        elif self.is_sending_many:
+          command_to_send = next(self.print_lines, '')
+          line = self.print_index
+          self.print_index += 1
+        else:
+          break
 
         try:
-          self.waiting_for_ok = True
-          self.gpx.stdin.write(command_to_send.strip() + "\n")
+          with self.write_lock:
+            # Timed before the write, the GIL may not come back right after it.
+            sent_at = time.time()
+            self.gpx.stdin.write(command_to_send.strip() + "\n")
+            self.in_flight.append((command_to_send.strip(), sent_at, False, line))
+          self.lines_sent.add()
         except IOError as io:
           print "X3G / IOError writing '" + str(command_to_send.strip()) + "'", io
           self.ok = False
+          break
         except Exception as e:
           print "X3G Error", e
           self.ok = False
+          break
 
-        if self.is_sending_many and len(self.commands_to_send) == 0:
+        if self.is_sending_many and self.print_index >= self.print_queue_size:
           self.is_sending_many = False
+          completed = True
 
-          if self.on_complete != None:
-            self.on_complete()
+    # Called without self.lock, which isn't reentrant: on_complete may well
+    # queue the next segment's commands.
+    if completed and self.on_complete != None:
+      self.on_complete()
 
   def _check_for_exit(self):
-    with self.lock:
-      has_terminated = self.gpx.poll()
-      if has_terminated != None:
-        self.ok = False
+    # Both pipes at EOF means gpx is exiting, if it hasn't quite yet
+    # nothing would wake us to poll again.
+    has_terminated = self.gpx.poll() if self._partial else self.gpx.wait()
+    if has_terminated != None:
+      self.ok = False
 
   def end_print(self):
     with self.lock:
       print "x3g.py end print"
-      self.commands_to_send = []
+      self.commands_to_send.clear()
+      self.print_lines = iter([])
       self.is_sending_many = False
+      self.job = None
 
   def stop(self):
     self.running = False
+    self._wake()
+
+  def stats(self):
+    return {'lines_sent': self.lines_sent.report(), 'packets_sent': self.packets_sent.report(), 'ok_latency': self.ok_latency.report(), 'failures': self.failures,
+            'priority_latency': self.priority_latency.report(),
+            'window': {'size': int(self.window), 'max': self.max_window, 'in_flight': len(self.in_flight)},
+            'lock_wait': {'printer': self.lock.wait.report()}}
+
+  @property
+  def streaming(self):
+    return self.job is not None
 
   @property
   def printing(self):
@@ -169,12 +538,17 @@ class X3GPrinter:
 
   @property
   def queueindex(self):
-    index = self.print_queue_size - len(self.commands_to_send)
+    return self.print_index
 
-    if index < 0:
-      return 0
-
-    return index
+  @property
+  def acknowledged_index(self):
+    # The first print line gpx hasn't acknowledged, the stream's packets are
+    # acknowledged before print_index moves.
+    with self.lock:
+      for command, sent_at, priority, index in self.in_flight:
+        if index is not None:
+          return index
+      return self.print_index
     
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+import os
+import sys
+import array
+import bisect
+import struct
+import hashlib
+import tempfile
+import threading
+import subprocess
+from gcodecache import evict
+
+# Payload lengths after the command byte, from GPX/scripts/s3g-decompiler.py
+# for the actions and gpx.c for the queries gpx can write into a file.
+_fixed_lengths = dict((command, struct.calcsize(layout)) for command, layout in {
+    0: '<H', 1: '', 2: '', 3: '', 7: '', 8: '', 11: '', 12: '<HB', 15: '', 17: '', 18: '<B', 20: '', 21: '', 22: '<B', 23: '', 24: '', 27: '<H',
+    129: '<iiiI', 130: '<iii', 131: '<BIH', 132: '<BIH', 133: '<I', 134: '<B', 135: '<BHH', 137: '<B', 138: '<H', 139: '<iiiiiI',
+    140: '<iiiii', 141: '<BHH', 142: '<iiiiiIB', 143: '<b', 144: '<b', 145: '<BB', 146: '<BBBBB', 147: '<HHB', 148: '<BHB',
+    150: '<BB', 151: '<B', 152: '<B', 154: '<B', 155: '<iiiiiIBfh', 156: '<B', 157: '<BBBIHHIIB', 158: '<f'}.iteritems())
+# Tool actions: tool, command, payload length, payload. Tool queries
+# (10) have no length byte, gpx doesn't write them into files.
+_tool_commands   = (136,)
+# Fixed fields followed by a NUL terminated string.
+_string_commands = {14: 0, 16: 0, 149: 4, 153: 4}
+
+def _crc_table():
+    table = []
+    for value in xrange(256):
+        for bit in xrange(8): value = (value >> 1) ^ 0x8C if value & 1 else value >> 1
+        table.append(value)
+    return(table)
+
+_crc = _crc_table()
+
+def crc(payload):
+    """The iButton/Maxim CRC-8 s3g packets end with."""
+    value = 0
+    for byte in bytearray(payload): value = _crc[value ^ byte]
+    return(value)
+
+def frame(payload):
+    return('\xd5' + chr(len(payload)) + payload + chr(crc(payload)))
+
+# An s3g payload's length is one byte.
+_max_packet = 255
+
+def packet_length(data, offset):
+    """Length of the unframed packet starting at `offset` of `data`, a
+    ValueError if it's unknown or doesn't end within `data`."""
+    command = ord(data[offset])
+    if command in _fixed_lengths:
+        length = 1 + _fixed_lengths[command]
+    elif command in _tool_commands or command == 13:
+        length = 4 + ord(data[offset + 3]) if offset + 3 < len(data) else None
+    elif command in _string_commands:
+        end    = data.find('\0', offset + 1 + _string_commands[command])
+        length = end + 1 - offset if end >= 0 else None
+    else:
+        raise ValueError('Unknown x3g command %d' % command)
+    if length is None or offset + length > len(data): raise ValueError('Truncated x3g packet')
+    return(length)
+
+class X3GJob:
+    """A G-code file compiled to framed s3g packets, as stored by X3GCache.
+
+    Markers taken every marker_stride source lines map packet numbers back
+    to the lines they came from, so a streamed job reports progress in
+    lines like one sent through gpx does. They follow the packets, at
+    the offset the header ends with.
+    """
+    _header    = '<4sHIIIQ'
+    _magic     = 'BX3G'
+    _version   = 2
+    _read_size = 1 << 20
+
+    def __init__(self, path, line_count, packet_count, marker_packets, marker_lines, data_offset):
+        self.path           = path
+        self.line_count     = line_count
+        self.packet_count   = packet_count
+        self.marker_packets = marker_packets
+        self.marker_lines   = marker_lines
+        self.data_offset    = data_offset
+        self.index          = None
+
+    def __len__(self):
+        return(self.line_count)
+
+    def line_at(self, packet):
+        """The source line that packet number `packet` was compiled from."""
+        marker = bisect.bisect_right(self.marker_packets, packet) - 1
+        return(self.marker_lines[marker] if marker >= 0 else 0)
+
+    def packets(self):
+        """Iterates the framed packets, read from disk as they are asked for."""
+        with open(self.path, 'rb') as f:
+            f.seek(self.data_offset)
+            for packet in xrange(self.packet_count):
+                head = f.read(2)
+                if len(head) < 2: return
+                yield head + f.read(ord(head[1]) + 1)
+
+    @classmethod
+    def write(cls, f, line_count, x3g, marker):
+        """Frames the unframed packets read from the file `x3g` into `f`,
+        which must be seekable, a chunk at a time. 149 (display message)
+        packets whose text starts with `marker` followed by a line number
+        are the markers, dropped from the job."""
+        f.write('\0' * struct.calcsize(cls._header))
+        packets        = 0
+        marker_packets = array.array('I')
+        marker_lines   = array.array('I')
+        data           = ''
+        offset         = 0
+        position       = 0
+        done           = False
+        while not done:
+            chunk     = x3g.read(cls._read_size)
+            done      = not chunk
+            data      = data[offset:] + chunk
+            position += offset
+            offset    = 0
+            body      = []
+            # Until the end of the file, a packet cut off by the chunk is kept for the next one.
+            while offset < len(data) and (done or len(data) - offset > _max_packet):
+                try:
+                    length = packet_length(data, offset)
+                except ValueError as e:
+                    raise ValueError('%s at byte %d' % (e, position + offset))
+                payload = data[offset:offset + length]
+                offset += length
+                if payload[0] == '\x95' and payload[5:5 + len(marker)] == marker:
+                    marker_packets.append(packets)
+                    marker_lines.append(int(payload[5 + len(marker):-1]))
+                    continue
+                body.append(frame(payload))
+                packets += 1
+            f.write(''.join(body))
+
+        marker_offset = f.tell()
+        if sys.byteorder == 'big':
+            marker_packets.byteswap()
+            marker_lines.byteswap()
+        f.write(marker_packets.tostring())
+        f.write(marker_lines.tostring())
+        f.seek(0)
+        f.write(struct.pack(cls._header, cls._magic, cls._version, line_count, packets, len(marker_lines), marker_offset))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = f.read(struct.calcsize(cls._header))
+            if len(header) != struct.calcsize(cls._header): raise ValueError('Truncated x3g job')
+            magic, version, line_count, packet_count, marker_count, marker_offset = struct.unpack(cls._header, header)
+            if magic != cls._magic or version != cls._version: raise ValueError('Not an x3g job of this version')
+            f.seek(marker_offset)
+            marker_packets = array.array('I')
+            marker_lines   = array.array('I')
+            marker_packets.fromfile(f, marker_count)
+            marker_lines.fromfile(f, marker_count)
+            if sys.byteorder == 'big':
+                marker_packets.byteswap()
+                marker_lines.byteswap()
+            return(cls(path, line_count, packet_count, marker_packets, marker_lines, len(header)))
+
+class X3GCache:
+    """Compiled X3GJob files, keyed by the G-code content hash (from the
+    GCodeCache) and the x3g settings gpx was configured with.
+
+    Compiling runs gpx over the whole file once, outside the serial path,
+    with an M70 marker every marker_stride lines. Least recently used jobs
+    are evicted past max_bytes like the index cache's.
+    """
+    marker_stride = 16
+    _marker       = 'BJ:'
+
+    def __init__(self, directory, gcode_cache, max_bytes=1 << 30):
+        self.directory   = directory
+        self.gcode_cache = gcode_cache
+        self.max_bytes   = max_bytes
+        self._lock       = threading.Lock()
+
+    def key(self, path, settings):
+        digest = hashlib.sha1(self.gcode_cache.key(path))
+        digest.update(repr(sorted(settings.items())))
+        digest.update(repr((self.marker_stride, X3GJob._version)))
+        return(digest.hexdigest())
+
+    def job_for(self, source, settings, gpx_command):
+        """X3GJob for the GCodeSource `source`, compiling it with
+        `gpx_command` (gpx and its options, without file names) on a miss."""
+        entry = os.path.join(self.directory, self.key(source.path, settings) + '.x3g')
+        try:
+            job = X3GJob.load(entry)
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError, EOFError):
+            # One compile at a time, gpx is single threaded and so is the Pi.
+            with self._lock:
+                self._compile(source, gpx_command, entry)
+            job = X3GJob.load(entry)
+        job.index = source.index
+        return(job)
+
+    def _compile(self, source, gpx_command, entry):
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+        fd, marked = tempfile.mkstemp('.gcode', dir=self.directory)
+        compiled   = marked[:-len('.gcode')] + '.out'
+        temp       = marked[:-len('.gcode')] + '.tmp'
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for number, line in enumerate(source):
+                    if not number % self.marker_stride: f.write('M70 P0 (' + self._marker + str(number) + ')\n')
+                    f.write(line + '\n')
+
+            gpx = subprocess.Popen(gpx_command + [marked, compiled], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+            output = gpx.communicate()[0]
+            if gpx.returncode != 0: raise OSError('gpx exited with %d: %s' % (gpx.returncode, output.strip()))
+
+            with open(compiled, 'rb') as x3g, open(temp, 'wb') as f:
+                X3GJob.write(f, len(source), x3g, self._marker)
+            os.rename(temp, entry)
+        finally:
+            for path in (marked, compiled, temp):
+                if os.path.exists(path): os.remove(path)
+        evict(self.directory, '.x3g', self.max_bytes)